@@ -0,0 +1,31 @@
+import numpy as np
+from js.utils.timing import StopWatch
+from js.algorithms.dpMeans import DPmeans
+
+def SampleClusters(N,K,D=3,sigma=0.1):
+  # N data points around K random centers
+  mus = np.random.randn(D,K)*K**(1./D)
+  return mus[:,np.random.randint(K,size=N)] + sigma*np.random.randn(D,N)
+
+def TimeSweeps(x,lamb,mode,Tmax):
+  dpmeans = DPmeans(lamb,mode)
+  sw = StopWatch(False)
+  dpmeans.Compute(x,Tmax)
+  return sw.toc(), dpmeans.K
+
+if __name__=="__main__":
+  np.random.seed(1)
+  Tmax = 6
+  lamb = 0.5
+  modes = ['sequential','batch','bounded']
+  results = []
+  for N in [1000, 10000, 50000]:
+    for K in [10, 100, 500]:
+      x = SampleClusters(N,K)
+      results.append((N,K,[TimeSweeps(x,lamb,mode,Tmax) for mode in modes]))
+  print 'N\tK\t'+'\t'.join(['K {}\t{} [s]'.format(mode,mode) for mode in modes]) \
+      + '\t' + '\t'.join(['speedup {}'.format(mode) for mode in modes[1::]])
+  for N,K,res in results:
+    print '{}\t{}\t'.format(N,K) \
+        + '\t'.join(['{}\t{:.3f}'.format(Kmode,dt) for dt,Kmode in res]) + '\t' \
+        + '\t'.join(['{:.1f}'.format(res[0][0]/dt) for dt,Kmode in res[1::]])
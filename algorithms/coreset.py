@@ -0,0 +1,102 @@
+import numpy as np
+from js.algorithms.dpMeans import DPmeans, GroupedSums
+from js.algorithms.dpvMFmeans import DPvMFmeans
+
+def GridCoreset(x,cellSize,ws=None,normalize=False):
+  '''
+  Weighted coreset of the DxN data x from the (weighted) means of the
+  occupied grid cells of side length cellSize. Every data point lies
+  within sqrt(D)*cellSize of its representative, so the DP-means cost of
+  any clustering changes by at most ws.sum()*sqrt(D)*cellSize. With
+  normalize the representatives are projected back onto the unit sphere
+  (e.g. for surface normals).
+  Returns the representatives xc, their weights wc and the cell index of
+  every data point.
+  '''
+  cells = np.floor(x/cellSize).astype(np.int64)
+  _, inv = np.unique(cells.T,axis=0,return_inverse=True)
+  inv = inv.ravel()
+  Kc = inv.max()+1
+  wc, xSums, _ = GroupedSums(x,inv,Kc,ws,scatter=False)
+  xc = xSums/wc
+  if normalize:
+    xc /= np.sqrt((xc**2).sum(axis=0))
+  return xc, wc, inv
+
+def SensitivityCoreset(x,m,lamb,ws=None,it=3):
+  '''
+  Weighted coreset of m samples of the DxN data x drawn proportional to
+  their sensitivity under a rough DP-means clustering with parameter
+  lamb after it sweeps: s_i = w_i d_i / sum_j w_j d_j + w_i / W_{z_i}, where d_i is the
+  distance to the centroid and W_k the weight of cluster k. Each sample
+  is weighted by w_i/(m p_i) so that the weighted cost is an unbiased
+  estimate of the full cost; samples drawn several times are merged.
+  Returns the samples xc, their weights wc and their indices into x.
+  '''
+  N = x.shape[1]
+  if ws is None:
+    ws = np.ones(N)
+  dpMeans = DPmeans(lamb,'batch')
+  dpMeans.Compute(x,it+1,ws=ws)
+  d = np.sqrt(((x-dpMeans.mus[:,dpMeans.zs])**2).sum(axis=0))
+  Wk = np.bincount(dpMeans.zs,weights=ws,minlength=dpMeans.K)
+  wd = ws*d
+  s = ws/Wk[dpMeans.zs]
+  if wd.sum() > 0.:
+    s += wd/wd.sum()
+  p = s/s.sum()
+  ids, counts = np.unique(np.random.choice(N,size=m,p=p),return_counts=True)
+  wc = counts*ws[ids]/(m*p[ids])
+  return x[:,ids], wc, ids
+
+def FitMlDPGMMCoreset(xs,lamb,m=None,cellSize=None,it=20,ws=None,
+    mode='batch'):
+  '''
+  Like FitMlDPGMM but clustering a weighted coreset of xs: either m
+  data points drawn by sensitivity sampling or the means of grid cells
+  of size cellSize.
+  '''
+  if m is None:
+    xc, wc, _ = GridCoreset(xs,cellSize,ws)
+  else:
+    xc, wc, _ = SensitivityCoreset(xs,m,lamb,ws)
+  dpMeans = DPmeans(lamb,mode)
+  dpMeans.Compute(xc,it,ws=wc)
+  Ns, mus, Ss = dpMeans.GetClusterParameters(xc,wc,countWeights=True)
+  pi = Ns/float(Ns.sum())
+  return mus, Ss, pi
+
+def FitMlDPvMFMMCoreset(ns,lamb,cellSize,it=20,ws=None,mu=None):
+  '''
+  Like FitMlDPvMFMM but clustering the normalized grid cell means of the
+  Nx3 normals ns weighted by the number of normals in each cell.
+  '''
+  qc, wc, _ = GridCoreset(ns.T,cellSize,ws,normalize=True)
+  dpMeans = DPvMFmeans(lamb, mu)
+  dpMeans.AddObservations(qc.T,wc)
+  f, fPrev = 0,0
+  for i in range(it):
+    dpMeans.UpdateMeans()
+    fPrev = f
+    f = dpMeans.UpdateLabels()
+    if f-fPrev <= 0.:
+      break
+  Ns, mus, taus = dpMeans.GetClusterParameters(dpMeans.ws,countWeights=True)
+  pi = Ns/float(Ns.sum())
+  return mus, taus, pi
+
+if __name__=="__main__":
+  # a sensitivity coreset of four well separated blobs
+  np.random.seed(1)
+  centers = np.array([[0.,0.],[5.,0.],[0.,5.],[5.,5.]]).T
+  x = centers[:,np.random.randint(4,size=2000)] + 0.2*np.random.randn(2,2000)
+  # the rough clustering that SensitivityCoreset samples from has to
+  # resolve the blobs
+  dpMeans = DPmeans(1.,'batch')
+  dpMeans.Compute(x,3+1)
+  assert dpMeans.K > 1, dpMeans.K
+  xc, wc, ids = SensitivityCoreset(x,200,1.)
+  print 'coreset of {} points with total weight {:.1f}'.format(xc.shape[1],
+      wc.sum())
+  mus, Ss, pi = FitMlDPGMMCoreset(x,1.,m=200)
+  print mus
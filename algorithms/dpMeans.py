@@ -1,122 +1,890 @@
 # Copyright (c) 2015, Julian Straub <jstraub@csail.mit.edu> Licensed
 # under the MIT license. See the license file LICENSE.
 import numpy as np
+import ctypes
+import multiprocessing as mp
+from multiprocessing.sharedctypes import RawArray
+from js.utils.timing import StopWatch
 
 def normed(x):
   # return unit L2 length vectors
   return x / np.sqrt((x**2).sum(axis=0)) 
 
-def FitMlDPGMM(xs,lamb,it=20, ws=None):
-  dpMeans = DPmeans(lamb)
+def FitMlDPGMM(xs,lamb,it=20, ws=None, mode='sequential', nWorkers=None):
+  dpMeans = DPmeans(lamb, mode, nWorkers=nWorkers)
   dpMeans.Compute(xs,it)
   Ns, mus, Ss = dpMeans.GetClusterParameters(xs,ws)
   pi = Ns/float(Ns.sum())
   return mus, Ss, pi
 
+def FitMlDPGMMStream(chunks,lamb,chunkSize=4096):
+  '''
+  Like FitMlDPGMM but for data that is passed in as an iterable of DxN_i
+  chunks (or (chunk, weights) tuples) which are only seen once.
+  '''
+  dpMeans = DPmeans(lamb, 'batch', chunkSize)
+  dpMeans.ComputeStream(chunks)
+  Ns, mus, Ss = dpMeans.GetStreamClusterParameters()
+  pi = Ns/float(Ns.sum())
+  return mus, Ss, pi
+
+def FitMlDPGMMFrames(frames,lamb,Q,tau,it=20,eps=1e-3):
+  '''
+  Fit a GMM to each DxN frame of the iterable frames where every frame
+  is warm-started from the clusters of the previous frames (see
+  DPmeans.ComputeTemporal). Yields mus, Ss, pi for each frame.
+  '''
+  dpMeans = DPmeans(lamb)
+  for xs in frames:
+    dpMeans.ComputeTemporal(xs,Q,tau,it,eps)
+    Ns, mus, Ss = dpMeans.GetClusterParameters(xs)
+    pi = Ns/float(Ns.sum())
+    yield mus, Ss, pi
+
+def SqDists(x,mus):
+  '''
+  Squared distances between the columns of mus and the columns of x
+  as a KxN matrix; the cross term is a single matrix product.
+  '''
+  d2 = -2.*mus.T.dot(x)
+  d2 += (mus**2).sum(axis=0)[:,np.newaxis]
+  d2 += (x**2).sum(axis=0)[np.newaxis,:]
+  return np.maximum(d2,0.)
+
+def SelectOpeners(xf,lamb):
+  '''
+  Indices of the data points among the DxN xf (ordered as in the sweep)
+  that open a new cluster: like in the sequential sweep the first of
+  them does and each following one only does if no cluster opened
+  before it is within lamb.
+  '''
+  lamb2 = lamb**2
+  d2best = np.ones(xf.shape[1])*np.inf
+  openers = []
+  j = 0
+  while j < xf.shape[1]:
+    openers.append(j)
+    d2best[j+1::] = np.minimum(d2best[j+1::],
+        ((xf[:,j+1::] - xf[:,j][:,np.newaxis])**2).sum(axis=0))
+    jNext = np.where(d2best[j+1::] > lamb2)[0]
+    if jNext.size == 0:
+      break
+    j += 1 + jNext[0]
+  return np.array(openers,dtype=np.int)
+
+def AssignToOpened(x,z,d2min,musNew,iOpen,K):
+  '''
+  Relabel the DxN data points x with labels z and squared distances
+  d2min to their centroids against the clusters musNew which were
+  opened by the data points iOpen (indices relative to x; negative if
+  opened before x). A cluster is only available to the data points
+  after the one that opened it and gets the label K plus its index in
+  musNew. z and d2min are updated in place.
+  '''
+  i0 = max(iOpen[0],0)
+  if i0 >= x.shape[1]:
+    return
+  d2 = SqDists(x[:,i0::],musNew)
+  d2[iOpen[:,np.newaxis] > np.arange(i0,x.shape[1])[np.newaxis,:]] = np.inf
+  zNew = np.argmin(d2,axis=0)
+  d2New = d2[zNew,np.arange(d2.shape[1])]
+  # on ties the sequential argmin prefers the existing clusters
+  closer = d2New < d2min[i0::]
+  z[i0::][closer] = K + zNew[closer]
+  d2min[i0::][closer] = d2New[closer]
+
+def Covariances(Ns,mus,S,Nw2,counts):
+  '''
+  Unbiased weighted covariances (KxDxD) of all clusters from their
+  weighted counts Ns, weighted means mus (DxK), weighted scatter matrices
+  S (KxDxD) and sums of squared weights Nw2. Clusters with at most one
+  data point (counts) get a broad covariance.
+  '''
+  D = mus.shape[0]
+  Ss = np.tile(np.identity(D)*1e6,(Ns.size,1,1))
+  ks = counts > 1
+  Ss[ks] = (S[ks] - Ns[ks,np.newaxis,np.newaxis]*np.einsum('dk,ek->kde',
+    mus[:,ks],mus[:,ks]))/(Ns[ks]-Nw2[ks]/Ns[ks])[:,np.newaxis,np.newaxis]
+  return Ss
+
+def SumDists(x,zs,mus,chunkSize=4096,squared=False,ws=None):
+  '''
+  Sum of the (squared and optionally weighted) distances of the data
+  points x to their centroids mus[:,zs], gathering the centroids of
+  chunkSize data points at a time.
+  '''
+  f = 0.
+  for i0 in range(0,x.shape[1],chunkSize):
+    xc = x[:,i0:i0+chunkSize]
+    d = ((xc-mus[:,zs[i0:i0+chunkSize]])**2).sum(axis=0)
+    if not squared:
+      d = np.sqrt(d)
+    f += d.sum() if ws is None else d.dot(ws[i0:i0+chunkSize])
+  return f
+
+def FitMlDPGMMPath(xs,lambs,it=20,ws=None,nWorkers=None,chunkSize=4096,
+    chainLength=4):
+  '''
+  Fit DP-means GMMs for all values in lambs. The values are sorted from
+  large to small and cut into chains of chainLength values; the first
+  value of a chain is fit from scratch and every following one is
+  warm-started from the clustering of the previous one including its
+  distance bounds. The chains only depend on lambs and chainLength, not
+  on how they are distributed over the pool of nWorkers processes
+  (default: one per CPU) which share xs and ws. Longer chains share more
+  work but warm starts from a much larger lamb can end in worse optima
+  than a fit from scratch. Returns a list of (lamb, K, cost, mus, Ss, pi)
+  in the order of lambs.
+  '''
+  lambs = np.asarray(lambs,dtype=np.float)
+  order = np.argsort(lambs)[::-1]
+  chains = [(lambs[order[i0:i0+chainLength]],it,chunkSize) for i0 in
+      range(0,lambs.size,chainLength)]
+  nWorkers = mp.cpu_count() if nWorkers is None else nWorkers
+  nWorkers = min(nWorkers,len(chains))
+  D,N = xs.shape
+  if nWorkers == 1:
+    _shared['x'], _shared['ws'] = xs, ws
+    try:
+      results = [_PathChain(chain) for chain in chains]
+    finally:
+      del _shared['x'], _shared['ws']
+  else:
+    xShared = RawArray(ctypes.c_double,D*N)
+    np.frombuffer(xShared).reshape(D,N)[:,:] = xs
+    wsShared = None
+    if not ws is None:
+      wsShared = RawArray(ctypes.c_double,N)
+      np.frombuffer(wsShared)[:] = ws
+    pool = mp.Pool(nWorkers,_InitPathWorker,(xShared,D,N,wsShared))
+    try:
+      results = pool.map(_PathChain,chains,chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+  path = [None]*lambs.size
+  for i,result in zip(order,[r for chain in results for r in chain]):
+    path[i] = result
+  return path
+
+# data shared with the worker processes of DPmeans in 'parallel' mode and
+# of FitMlDPGMMPath
+_shared = {}
+
+def _InitPathWorker(x,D,N,ws=None):
+  _shared['x'] = np.frombuffer(x).reshape(D,N)
+  _shared['ws'] = None if ws is None else np.frombuffer(ws)
+
+def _PathChain(args):
+  '''
+  Fit the decreasing values lambs one after the other on the shared data,
+  the first from scratch and the others warm-started.
+  '''
+  lambs,it,chunkSize = args
+  x, ws = _shared['x'], _shared['ws']
+  dpMeans = DPmeans(lambs[0],'bounded',chunkSize)
+  results = []
+  for i,lamb in enumerate(lambs):
+    dpMeans.lamb = lamb
+    dpMeans.Compute(x,it,warm=i>0,ws=ws)
+    cost = dpMeans.C[np.nonzero(dpMeans.C)[0][-1]]
+    Ns, mus, Ss = dpMeans.GetClusterParameters(x,ws)
+    results.append((lamb,dpMeans.K,cost,mus,Ss,Ns/float(Ns.sum())))
+  return results
+
+def _InitWorker(x,zs,d2,D,N,ws=None):
+  _shared['x'] = np.frombuffer(x).reshape(D,N)
+  _shared['zs'] = np.frombuffer(zs,dtype=np.int64)
+  _shared['d2'] = np.frombuffer(d2)
+  _shared['ws'] = None if ws is None else np.frombuffer(ws)
+
+def _AssignShard(args):
+  '''
+  Label the shared data points i0:i1 against the centroids mus and
+  propose the ones further than lamb from all centroids for new clusters.
+  '''
+  i0,i1,mus,lamb,chunkSize = args
+  x, zs, d2min = _shared['x'], _shared['zs'], _shared['d2']
+  far = [np.zeros(0,dtype=np.int)]
+  for j0 in range(i0,i1,chunkSize):
+    j1 = min(j0+chunkSize,i1)
+    d2 = SqDists(x[:,j0:j1],mus)
+    zs[j0:j1] = np.argmin(d2,axis=0)
+    d2min[j0:j1] = d2[zs[j0:j1],np.arange(j1-j0)]
+    far.append(j0+np.where(d2min[j0:j1] > lamb**2)[0])
+  return np.concatenate(far)
+
+def _RelabelShard(args):
+  '''
+  Relabel the shared data points i0:i1 against the accepted new clusters.
+  '''
+  i0,i1,musNew,iOpen,K,chunkSize = args
+  x, zs, d2min = _shared['x'], _shared['zs'], _shared['d2']
+  for j0 in range(i0,i1,chunkSize):
+    j1 = min(j0+chunkSize,i1)
+    AssignToOpened(x[:,j0:j1],zs[j0:j1],d2min[j0:j1],musNew,iOpen-j0,K)
+
+def _SumShard(args):
+  i0,i1,K = args
+  ws = _shared['ws']
+  Ns, xSums, _ = GroupedSums(_shared['x'][:,i0:i1],_shared['zs'][i0:i1],
+      K,None if ws is None else ws[i0:i1],scatter=False)
+  return Ns, xSums
+
+def _CostShard(args):
+  i0,i1,mus,chunkSize = args
+  ws = _shared['ws']
+  return SumDists(_shared['x'][:,i0:i1],_shared['zs'][i0:i1],mus,chunkSize,
+      ws=None if ws is None else ws[i0:i1])
+
+def GroupedSums(x,z,K,ws=None,scatter=True):
+  '''
+  Sums of the weights, the weighted data points and optionally the
+  weighted outer products of the data points per label in one pass over
+  the DxN data x. Returns a K vector, a DxK and a KxDxD array.
+  '''
+  D = x.shape[0]
+  if ws is None:
+    ws = np.ones(x.shape[1])
+  Ns = np.bincount(z,weights=ws,minlength=K)
+  xSums = np.zeros((D,K))
+  for d in range(D):
+    xSums[d,:] = np.bincount(z,weights=ws*x[d,:],minlength=K)
+  if not scatter:
+    return Ns, xSums, None
+  Ss = np.zeros((K,D,D))
+  for d in range(D):
+    for e in range(d,D):
+      Ss[:,d,e] = np.bincount(z,weights=ws*x[d,:]*x[e,:],minlength=K)
+      Ss[:,e,d] = Ss[:,d,e]
+  return Ns, xSums, Ss
+
+class CentroidStore(object):
+  '''
+  Centroids and counts of clusters in buffers whose capacity doubles when
+  they are full. Removed clusters are only marked dead and keep their
+  slot until Compact() so that births and deaths of clusters during a
+  sweep do not copy all centroids or relabel all data points.
+  '''
+  def __init__(self,mus,Ns):
+    D,K = mus.shape
+    cap = max(16,2*K)
+    self.mus = np.zeros((D,cap))
+    self.mus[:,:K] = mus
+    self.Ns = np.zeros(cap,dtype=np.int)
+    self.Ns[:K] = Ns
+    self.alive = np.zeros(cap,dtype=np.bool)
+    self.alive[:K] = True
+    self.K = K # number of used slots including dead ones
+  def Add(self,mu):
+    if self.K == self.Ns.size:
+      self.mus = np.concatenate((self.mus,np.zeros_like(self.mus)),axis=1)
+      self.Ns = np.r_[self.Ns,np.zeros_like(self.Ns)]
+      self.alive = np.r_[self.alive,np.zeros_like(self.alive)]
+    self.mus[:,self.K] = mu.ravel()
+    self.Ns[self.K] = 0
+    self.alive[self.K] = True
+    self.K += 1
+    return self.K-1
+  def Remove(self,k):
+    self.alive[k] = False
+  def Dists(self,x_i):
+    ''' distances of x_i to all slots; inf for dead ones '''
+    d = np.sqrt(((x_i - self.mus[:,:self.K])**2).sum(axis=0))
+    d[~self.alive[:self.K]] = np.inf
+    return d
+  def Compact(self):
+    '''
+    Move the live clusters to the front keeping their order. Returns the
+    map from old slots to new labels.
+    '''
+    keep = self.alive[:self.K].copy()
+    K = keep.sum()
+    self.mus[:,:K] = self.mus[:,:self.K][:,keep]
+    self.Ns[:K] = self.Ns[:self.K][keep]
+    self.alive[:K] = True
+    self.alive[K:self.K] = False
+    relabel = np.cumsum(keep)-1
+    self.K = K
+    return relabel
+  def Get(self):
+    ''' copies of the centroids and counts of the compacted store '''
+    return self.mus[:,:self.K].copy(), self.Ns[:self.K].copy()
+
 class DPmeans(object):
-  def __init__(self, lamb):
+  def __init__(self, lamb, mode='sequential', chunkSize=4096, scatter=True,
+      nWorkers=None):
+    '''
+    mode selects the label assignment: 'sequential' assigns one data
+    point after the other; 'batch' assigns chunkSize data points at once
+    from a matrix of squared distances to all centroids; 'bounded' is
+    'batch' but skips the data points whose upper and lower distance
+    bounds prove that their label does not change; 'parallel' is 'batch'
+    on shards of the data in a pool of nWorkers processes (default: one
+    per CPU) where new clusters proposed by the workers are validated
+    centrally in sweep order.
+    scatter selects whether PartialFit also accumulates the scatter
+    matrices of the clusters which GetStreamClusterParameters needs.
+    '''
     self.lamb = lamb
-  def RemoveCluster(self,k):
-    self.mus = np.concatenate((self.mus[:,:k],self.mus[:,k+1::]),axis=1)
-    self.N_ = np.concatenate((self.N_[:k],self.N_[k+1::]),axis=1)
-    self.zs[self.zs>k] -= 1
-    self.K -= 1
+    if not mode in ['sequential','batch','bounded','parallel']:
+      raise ValueError(mode)
+    self.mode = mode
+    self.chunkSize = chunkSize
+    self.scatter = scatter
+    self.nWorkers = mp.cpu_count() if nWorkers is None else nWorkers
+    self.ws = None
+    self.K = 0
+  def SetCentroids(self,xSums,Ns=None):
+    '''
+    Set the centroids to the means given the per cluster sums xSums of
+    the (weighted) data points and total weights Ns (default: the counts)
+    and remove all empty clusters in one relabeling pass.
+    '''
+    if Ns is None:
+      Ns = self.N_
+    keep = self.N_ > 0
+    self.zs[:] = (np.cumsum(keep)-1)[self.zs]
+    self.mus = xSums[:,keep]/Ns[keep]
+    self.N_ = self.N_[keep]
+    self.K = keep.sum()
 
   def LabelAssign(self,i,x_i):
-    z_i = np.argmin(np.r_[np.sqrt(((x_i - self.mus)**2).sum(axis=0)),np.array([self.lamb])])
+    '''
+    Label of data point i against the clusters in self.store. The labels
+    are slots of the store until the sweep compacts it. A data point with
+    weight (self.ws) above 1 stands for several points and so is never
+    the last one in its cluster.
+    '''
+    d = self.store.Dists(x_i)
+    z_i = np.argmin(np.r_[d,np.array([self.lamb])])
     # check if this was the last datapoint in a cluster if so do not
     # assign to it again
-    if self.N_[self.zs[i]] == 0 and z_i == self.zs[i]:
-      self.RemoveCluster(self.zs[i])
-      z_i = np.argmin(np.r_[np.sqrt(((x_i - self.mus)**2).sum(axis=0)),np.array([self.lamb])])
+    if self.store.Ns[self.zs[i]] == 0 and z_i == self.zs[i] \
+        and (self.ws is None or self.ws[i] <= 1.):
+      self.store.Remove(self.zs[i])
+      d[self.zs[i]] = np.inf
+      z_i = np.argmin(np.r_[d,np.array([self.lamb])])
     # creata a new cluster if required
-    if z_i == self.K:
-      self.mus = np.concatenate((self.mus,x_i),axis=1)
-      self.N_ = np.concatenate((self.N_,np.array([0])),axis=0)
-      self.K += 1
+    if z_i == self.store.K:
+      self.store.Add(x_i)
     return z_i
 
-  def Compute(self,x,Tmax=100):
+  def BatchLabelAssign(self,x,ws=None):
+    '''
+    Assign labels to all data points in chunks of self.chunkSize points.
+    Data points that are further than lamb away from all centroids open
+    new clusters in the same order in which the sequential sweep would
+    have opened them. ws are the optional weights of the data points
+    (see MergeSingletons).
+    '''
+    N = x.shape[1]
+    lamb2 = self.lamb**2
+    K0 = self.K
+    zsPrev = self.zs.copy()
+    if self.mode == 'bounded':
+      self.UpdateSeparation()
+    for i0 in range(0,N,self.chunkSize):
+      xc = x[:,i0:i0+self.chunkSize]
+      if self.mode == 'bounded':
+        z, d2min = self.BoundedChunkAssign(xc,i0,K0)
+      else:
+        z, d2min = self.NearestCentroids(xc)
+      far = np.where(d2min > lamb2)[0]
+      if far.size > 0:
+        if self.mode == 'bounded':
+          # the new clusters are compared against exact distances
+          j0 = far[0]
+          d2min[j0::] = ((xc[:,j0::] - self.mus[:,z[j0::]])**2).sum(axis=0)
+        z = self.SpawnClusters(xc,far,z,d2min)
+        if self.mode == 'bounded':
+          self.ub[i0:i0+xc.shape[1]] = np.sqrt(d2min)
+          self.lb[i0+far[0]:i0+xc.shape[1]] = 0.
+      self.zs[i0:i0+xc.shape[1]] = z
+    if self.mode == 'bounded' and self.K > K0:
+      # the lower bounds of data points labeled before a cluster was
+      # opened in this sweep do not account for that cluster yet
+      for i0 in range(0,N,self.chunkSize):
+        d2 = SqDists(x[:,i0:i0+self.chunkSize],self.mus[:,K0::])
+        self.lb[i0:i0+self.chunkSize] = np.minimum(
+            self.lb[i0:i0+self.chunkSize],np.sqrt(d2.min(axis=0)))
+    self.N_ = np.bincount(self.zs,minlength=self.K)
+    moved = self.MergeSingletons(x,zsPrev,ws)
+    if self.mode == 'bounded':
+      self.ub[moved] = np.inf
+      self.lb[moved] = 0.
+
+  def NearestCentroids(self,xc):
+    '''
+    Labels of the closest centroids to the data points in xc and the
+    squared distances to them.
+    '''
+    d2 = SqDists(xc,self.mus)
+    z = np.argmin(d2,axis=0)
+    return z, d2[z,np.arange(xc.shape[1])]
+
+  def UpdateSeparation(self):
+    '''
+    Half the distance of each centroid to its closest other centroid. A
+    data point closer than that to its centroid cannot be closer to any
+    other centroid.
+    '''
+    d2 = SqDists(self.mus,self.mus)
+    d2[np.diag_indices(self.K)] = np.inf
+    self.sep = 0.5*np.sqrt(d2.min(axis=0))
+
+  def BoundedChunkAssign(self,xc,i0,K0):
+    '''
+    Labels for the chunk xc starting at data point i0. Distances to all
+    centroids are only computed for the data points whose bounds do not
+    prove that their label stays the same and that they stay within
+    lamb. Clusters opened during this sweep (index >= K0) are not covered
+    by the bounds and always checked.
+    Returns the labels and the squared distances to the assigned
+    centroids which are upper bounds for the skipped data points.
+    '''
+    n = xc.shape[1]
+    z = self.zs[i0:i0+n].copy()
+    ub = self.ub[i0:i0+n]
+    lb = self.lb[i0:i0+n]
+    bound = np.maximum(lb,self.sep[z])
+    check = ~((ub < bound) & (ub <= self.lamb))
+    # tighten the upper bound before computing all distances
+    ic = np.where(check)[0]
+    ub[ic] = np.sqrt(((xc[:,ic] - self.mus[:,z[ic]])**2).sum(axis=0))
+    check[ic] = ~((ub[ic] < bound[ic]) & (ub[ic] <= self.lamb))
+    ic = np.where(check)[0]
+    if ic.size > 0:
+      d2 = SqDists(xc[:,ic],self.mus)
+      z[ic] = np.argmin(d2,axis=0)
+      ub[ic] = np.sqrt(d2[z[ic],np.arange(ic.size)])
+      d2[z[ic],np.arange(ic.size)] = np.inf
+      lb[ic] = np.sqrt(d2.min(axis=0))
+    iskip = np.where(~check)[0]
+    if self.K > K0 and iskip.size > 0:
+      d2 = SqDists(xc[:,iskip],self.mus[:,K0::])
+      zNew = np.argmin(d2,axis=0)
+      dNew = np.sqrt(d2[zNew,np.arange(iskip.size)])
+      lb[iskip] = np.minimum(lb[iskip],dNew)
+      # only if a new cluster beats the upper bound the exact distance to
+      # the assigned centroid decides
+      ic = np.where(dNew < ub[iskip])[0]
+      ub[iskip[ic]] = np.sqrt(((xc[:,iskip[ic]] - self.mus[:,z[iskip[ic]]])**2).sum(axis=0))
+      ic = ic[dNew[ic] < ub[iskip[ic]]]
+      z[iskip[ic]] = K0 + zNew[ic]
+      ub[iskip[ic]] = dNew[ic]
+      lb[iskip[ic]] = 0.
+    return z, ub**2
+
+  def UpdateBounds(self,musPrev):
+    '''
+    Loosen the bounds of all data points by how far the centroids moved
+    from musPrev: the upper bound by the drift of the own centroid and
+    the lower bound by the largest drift of any other centroid.
+    '''
+    drift = np.sqrt(((self.mus - musPrev)**2).sum(axis=0))
+    self.ub += drift[self.zs]
+    if self.K > 1:
+      kMax = np.argmax(drift)
+      driftOthers = np.ones(self.K)*drift[kMax]
+      driftOthers[kMax] = np.max(np.r_[drift[:kMax],drift[kMax+1::]])
+      self.lb -= driftOthers[self.zs]
+
+  def MergeSingletons(self,x,zsPrev,ws=None):
+    '''
+    The sequential sweep removes a cluster once its last data point would
+    be assigned to it again and relabels that data point against the
+    remaining clusters. Apply the same rule to the singleton clusters of
+    a batch sweep so that both sweeps have the same fixed points. As for
+    repeated data points the rule only applies to singletons of weight
+    (ws) at most 1.
+    '''
+    lamb2 = self.lamb**2
+    single = (self.zs == zsPrev) & (self.N_[self.zs] == 1)
+    if not ws is None:
+      single &= ws <= 1.
+    ids = np.where(single)[0]
+    removed = np.zeros(self.K,dtype=np.bool)
+    moved = []
+    for i in ids:
+      k = self.zs[i]
+      if self.N_[k] > 1:
+        continue # another singleton was merged into this cluster
+      d2 = ((self.mus - x[:,i][:,np.newaxis])**2).sum(axis=0)
+      d2[k] = np.inf
+      d2[removed] = np.inf
+      j = np.argmin(d2)
+      if d2[j] <= lamb2:
+        self.zs[i] = j
+        self.N_[k] -= 1
+        self.N_[j] += 1
+        removed[k] = True
+        moved.append(i)
+    return np.array(moved,dtype=np.int)
+
+  def SpawnClusters(self,xc,far,z,d2min):
+    '''
+    Open new clusters for the data points far in the chunk xc (see
+    SelectOpeners) and relabel the chunk against them.
+    '''
+    iOpen = far[SelectOpeners(xc[:,far],self.lamb)]
+    musNew = xc[:,iOpen]
+    AssignToOpened(xc,z,d2min,musNew,iOpen,self.K)
+    self.mus = np.concatenate((self.mus,musNew),axis=1)
+    self.K += iOpen.size
+    return z
+
+  def Compute(self,x,Tmax=100,warm=False,ws=None):
+    '''
+    Cluster the DxN data x. With warm=True the clustering continues from
+    the labels, centroids and (in 'bounded' mode) distance bounds of the
+    previous Compute on the same data, e.g. after changing lamb; this is
+    not supported in 'parallel' mode.
+    ws are optional weights of the data points, e.g. the number of data
+    points each one stands for in a coreset. They weigh centroids and
+    cost but, as for repeated data points, not the decision to open a
+    new cluster; a data point of weight above 1 keeps its cluster alive
+    (see MergeSingletons).
+    '''
+    if self.mode == 'parallel':
+      return self.ComputeParallel(x,Tmax,ws)
     # init stuff
     print x.shape
     N = x.shape[1]
-    self.K = 1
-    self.zs = np.zeros(N,dtype=np.int) # labels for each data point
-    self.mus = x[:,0][:,np.newaxis] # the first data point always creates a cluster
-    self.N_ = np.bincount(self.zs,minlength=self.K) # counts per cluster
+    self.ws = ws
     self.C = np.zeros(Tmax) # cost function value
     self.C[0] = 1e6
+    if warm:
+      self.C[0] = np.inf
+    else:
+      self.K = 1
+      self.zs = np.zeros(N,dtype=np.int) # labels for each data point
+      self.mus = x[:,0][:,np.newaxis].copy() # the first data point always creates a cluster
+      self.N_ = np.bincount(self.zs,minlength=self.K) # counts per cluster
+    if self.mode == 'bounded' and not warm:
+      # upper and lower bounds on the distance of each data point to its
+      # own and to the closest other centroid
+      self.ub = np.ones(N)*np.inf
+      self.lb = np.zeros(N)
+    sw = StopWatch(False)
     for t in range(1,Tmax):
+      sw.tic()
       # label assignment
-      for i in range(N):
-        self.N_[self.zs[i]] -= 1 
-        self.zs[i] = self.LabelAssign(i,x[:,i][:,np.newaxis])
-        self.N_[self.zs[i]] += 1
+      if self.mode in ['batch','bounded']:
+        self.BatchLabelAssign(x,ws)
+      else:
+        self.store = CentroidStore(self.mus,self.N_)
+        for i in range(N):
+          self.store.Ns[self.zs[i]] -= 1 
+          self.zs[i] = self.LabelAssign(i,x[:,i][:,np.newaxis])
+          self.store.Ns[self.zs[i]] += 1
+        self.zs = self.store.Compact()[self.zs]
+        self.mus, self.N_ = self.store.Get()
+        self.K = self.mus.shape[1]
+        self.store = None
+      dtAssign = sw.toctic()
       # centroid update
-      for k in range(self.K-1,-1,-1):
-        if self.N_[k] > 0:
-          self.mus[:,k] = (x[:,self.zs==k].sum(axis=1))/self.N_[k]
-        else:
-          self.RemoveCluster(k)
+      musPrev = self.mus[:,self.N_>0]
+      Ns, xSums, _ = GroupedSums(x,self.zs,self.K,ws,scatter=False)
+      self.SetCentroids(xSums,Ns)
+      if self.mode == 'bounded':
+        self.UpdateBounds(musPrev)
+      dtUpdate = sw.toctic()
       # eval cost function
-      self.C[t] = np.array(\
-          [np.sqrt(((x[:,i][:,np.newaxis]-self.mus[:,z_i][:,np.newaxis])**2).sum(axis=0)) for i,z_i in enumerate(self.zs)]).sum() \
+      self.C[t] = SumDists(x,self.zs,self.mus,self.chunkSize,ws=ws) \
           + self.K*self.lamb
-      print 'iteration {}:\tcost={:2.5f};\tK={}\tavg counts={:2.2f} range={} {}'.format(t,
-          self.C[t],self.K,np.mean(self.N_),np.min(self.N_),np.max(self.N_))
+      self.ReportIteration(t,dtAssign,dtUpdate,sw.toc())
       if self.C[t] >= self.C[t-1]:
         break;
-  def GetClusterParameters(self,xs, ws=None):
+  def ReportIteration(self,t,dtAssign,dtUpdate,dtCost):
+    print 'iteration {}:\tcost={:2.5f};\tK={}\tavg counts={:2.2f} range={} {}\tdt: assign={:.1f}ms update={:.1f}ms cost={:.1f}ms'.format(t,
+        self.C[t],self.K,np.mean(self.N_),np.min(self.N_),np.max(self.N_),
+        dtAssign*1000.,dtUpdate*1000.,dtCost*1000.)
+
+  def ComputeParallel(self,x,Tmax=100,ws=None):
+    '''
+    Compute in 'parallel' mode. The data points, labels and distances live
+    in shared memory so only centroids and proposals travel between the
+    processes. Each worker labels its shard and proposes the data points
+    further than lamb from all centroids; the proposals are accepted in
+    sweep order (SelectOpeners) and the workers relabel their shards
+    against the accepted clusters. This yields the labels of 'batch'.
+    '''
+    print x.shape
+    D,N = x.shape
+    xShared = RawArray(ctypes.c_double,D*N)
+    zsShared = RawArray(ctypes.c_int64,N)
+    d2Shared = RawArray(ctypes.c_double,N)
+    xs = np.frombuffer(xShared).reshape(D,N)
+    xs[:,:] = x
+    wsShared = None
+    if not ws is None:
+      wsShared = RawArray(ctypes.c_double,N)
+      np.frombuffer(wsShared)[:] = ws
+    self.zs = np.frombuffer(zsShared,dtype=np.int64)
+    nShards = min(N,4*self.nWorkers)
+    bounds = np.linspace(0,N,nShards+1).astype(np.int)
+    shards = zip(bounds[:-1],bounds[1::])
+    self.K = 1
+    self.mus = xs[:,0][:,np.newaxis].copy()
+    self.N_ = np.bincount(self.zs,minlength=self.K)
+    self.C = np.zeros(Tmax)
+    self.C[0] = 1e6
+    pool = mp.Pool(self.nWorkers,_InitWorker,(xShared,zsShared,d2Shared,D,N,
+      wsShared))
+    try:
+      sw = StopWatch(False)
+      for t in range(1,Tmax):
+        sw.tic()
+        zsPrev = self.zs.copy()
+        # label assignment and proposal of new clusters
+        far = np.concatenate(pool.map(_AssignShard,[(i0,i1,self.mus,
+          self.lamb,self.chunkSize) for i0,i1 in shards]))
+        if far.size > 0:
+          iOpen = far[SelectOpeners(xs[:,far],self.lamb)]
+          musNew = xs[:,iOpen]
+          pool.map(_RelabelShard,[(i0,i1,musNew,iOpen,self.K,
+            self.chunkSize) for i0,i1 in shards if i1 > iOpen[0]])
+          self.mus = np.concatenate((self.mus,musNew),axis=1)
+          self.K += iOpen.size
+        self.N_ = np.bincount(self.zs,minlength=self.K)
+        self.MergeSingletons(xs,zsPrev,ws)
+        dtAssign = sw.toctic()
+        # centroid update and removal of empty clusters
+        sums = pool.map(_SumShard,[(i0,i1,self.K) for i0,i1 in shards])
+        Ns = np.sum([Nsi for Nsi,xSumsi in sums],axis=0)
+        xSums = np.sum([xSumsi for Nsi,xSumsi in sums],axis=0)
+        self.SetCentroids(xSums,Ns)
+        dtUpdate = sw.toctic()
+        # eval cost function
+        self.C[t] = np.sum(pool.map(_CostShard,[(i0,i1,self.mus,
+          self.chunkSize) for i0,i1 in shards])) + self.K*self.lamb
+        self.ReportIteration(t,dtAssign,dtUpdate,sw.toc())
+        if self.C[t] >= self.C[t-1]:
+          break;
+    finally:
+      pool.close()
+      pool.join()
+    # copy the labels out of the shared memory
+    self.zs = self.zs.astype(np.int)
+
+  def SetPrior(self,mus,Ns,ages=None):
+    '''
+    Set the clusters (DxK centroids and counts) that ComputeTemporal
+    warm-starts from; ages are the numbers of frames since each cluster
+    was last observed (0 for clusters of the previous frame).
+    '''
+    K = Ns.size
+    self.priorMus = mus.copy()
+    self.priorWs = Ns.astype(np.float)
+    self.priorAges = np.zeros(K) if ages is None else ages.astype(np.float)
+    self.priorIds = np.arange(K)
+    self.nextId = K
+
+  def ComputeTemporal(self,x,Q,tau,Tmax=100,eps=1e-3):
+    '''
+    Dynamic means on the DxN frame x, warm-started from the clusters of
+    the previous frames (see SetPrior; the first frame starts empty).
+    As in DP-means a new cluster costs lamb**2 in squared distance. A
+    cluster that was last observed age frames ago can be revived for
+    Q*age; its centroid is pulled towards the old one with weight
+    gamma = 1/(1/w + tau*age) where w is its accumulated weight. Clusters
+    whose revival would cost more than a new cluster are forgotten.
+    Iterations stop once the cost decreases by less than a fraction eps.
+    Afterwards mus, zs, N_ and K describe the clusters observed in x and
+    ids holds their identities across frames.
+    '''
+    D,N = x.shape
+    if not hasattr(self,'priorMus'):
+      self.SetPrior(np.zeros((D,0)),np.zeros(0))
+    Ko = self.priorWs.size
+    ages = self.priorAges + 1.
+    gammas = 1./(1./self.priorWs + tau*ages)
+    self.K = Ko
+    self.mus = self.priorMus.copy()
+    if Ko == 0:
+      # the first data point always creates a cluster
+      self.K = 1
+      self.mus = x[:,0][:,np.newaxis].copy()
+    self.zs = np.zeros(N,dtype=np.int)
+    self.N_ = np.zeros(self.K,dtype=np.int)
+    self.C = np.zeros(Tmax) # cost function value
+    self.C[0] = np.inf
+    sw = StopWatch(False)
+    for t in range(1,Tmax):
+      sw.tic()
+      # label assignment; old clusters without data points in this
+      # frame have to be revived
+      revive = (np.arange(self.K) < Ko) & (self.N_ == 0)
+      scale = np.ones(self.K)
+      scale[revive] = gammas[revive[:Ko]]/(gammas[revive[:Ko]]+1.)
+      offset = np.zeros(self.K)
+      offset[revive] = Q*ages[revive[:Ko]]
+      self.TemporalLabelAssign(x,scale,offset)
+      dtAssign = sw.toctic()
+      # centroid update
+      Ns, xSums, _ = GroupedSums(x,self.zs,self.K,scatter=False)
+      self.N_ = Ns.astype(np.int)
+      g = np.r_[gammas,np.zeros(self.K-Ko)]
+      phis = np.concatenate((self.priorMus,np.zeros((D,self.K-Ko))),axis=1)
+      obs = self.N_ > 0
+      self.mus[:,obs] = (g[obs]*phis[:,obs] + xSums[:,obs])/(g[obs]+Ns[obs])
+      self.mus[:,~obs] = phis[:,~obs]
+      # new clusters that lost all their data points are removed
+      keep = obs | (np.arange(self.K) < Ko)
+      self.zs = (np.cumsum(keep)-1)[self.zs]
+      self.mus, self.N_, self.K = self.mus[:,keep], self.N_[keep], keep.sum()
+      obs, g, phis = obs[keep], g[keep], phis[:,keep]
+      dtUpdate = sw.toctic()
+      # eval cost function
+      self.C[t] = SumDists(x,self.zs,self.mus,self.chunkSize,squared=True) \
+          + (g[obs]*((self.mus[:,obs]-phis[:,obs])**2).sum(axis=0)).sum() \
+          + Q*ages[obs[:Ko]].sum() + (self.K-Ko)*self.lamb**2
+      self.ReportIteration(t,dtAssign,dtUpdate,sw.toc())
+      if self.C[t] >= (1.-eps)*self.C[t-1]:
+        break;
+    # carry the clusters over to the next frame
+    obs = self.N_ > 0
+    ws = np.r_[self.priorWs,np.zeros(self.K-Ko)]
+    ws[obs] = g[obs] + self.N_[obs]
+    ages = np.r_[ages,np.zeros(self.K-Ko)]
+    ages[obs] = 0.
+    ids = np.r_[self.priorIds,self.nextId+np.arange(self.K-Ko)]
+    self.nextId += self.K-Ko
+    alive = Q*(ages+1.) <= self.lamb**2
+    self.priorMus = self.mus[:,alive]
+    self.priorWs, self.priorAges, self.priorIds = ws[alive], ages[alive], ids[alive]
+    # expose only the clusters observed in this frame
+    self.zs = (np.cumsum(obs)-1)[self.zs]
+    self.mus, self.N_, self.K, self.ids = self.mus[:,obs], self.N_[obs], obs.sum(), ids[obs]
+
+  def TemporalLabelAssign(self,x,scale,offset):
+    '''
+    Assign labels to all data points in chunks where the cost of cluster
+    k is scale[k] times the squared distance plus offset[k]. Data points
+    whose cost exceeds lamb**2 for all clusters open new ones.
+    '''
+    lamb2 = self.lamb**2
+    for i0 in range(0,x.shape[1],self.chunkSize):
+      xc = x[:,i0:i0+self.chunkSize]
+      c = SqDists(xc,self.mus)*scale[:,np.newaxis] + offset[:,np.newaxis]
+      z = np.argmin(c,axis=0)
+      cmin = c[z,np.arange(xc.shape[1])]
+      far = np.where(cmin > lamb2)[0]
+      if far.size > 0:
+        K = self.K
+        z = self.SpawnClusters(xc,far,z,cmin)
+        scale = np.r_[scale,np.ones(self.K-K)]
+        offset = np.r_[offset,np.zeros(self.K-K)]
+      self.zs[i0:i0+xc.shape[1]] = z
+
+  def PartialFit(self,x,ws=None):
+    '''
+    Streaming DP-means: assign the DxN chunk x to the current clusters,
+    opening new ones for data points further than lamb away, and fold it
+    into the running (weighted) sufficient statistics of the clusters.
+    The centroids are the means of everything seen so far; the data
+    points themselves are not kept. Returns the labels of the chunk.
+    '''
+    if x.shape[1] == 0:
+      return np.zeros(0,dtype=np.int)
+    if self.K == 0:
+      D = x.shape[0]
+      self.K = 1
+      self.mus = x[:,0][:,np.newaxis].copy()
+      self.N_ = np.zeros(0,dtype=np.int)
+      self.Nw_ = np.zeros(0)
+      self.Nw2_ = np.zeros(0)
+      self.xSum_ = np.zeros((D,0))
+      self.S_ = np.zeros((0,D,D)) if self.scatter else None
+    if ws is None:
+      ws = np.ones(x.shape[1])
+    lamb2 = self.lamb**2
+    zs = np.zeros(x.shape[1],dtype=np.int)
+    for i0 in range(0,x.shape[1],self.chunkSize):
+      xc = x[:,i0:i0+self.chunkSize]
+      z, d2min = self.NearestCentroids(xc)
+      far = np.where(d2min > lamb2)[0]
+      if far.size > 0:
+        z = self.SpawnClusters(xc,far,z,d2min)
+      zs[i0:i0+xc.shape[1]] = z
+    # grow the statistics by the clusters opened in this chunk
+    dK = self.K - self.N_.size
+    self.N_ = np.r_[self.N_,np.zeros(dK,dtype=np.int)]
+    self.Nw_ = np.r_[self.Nw_,np.zeros(dK)]
+    self.Nw2_ = np.r_[self.Nw2_,np.zeros(dK)]
+    self.xSum_ = np.concatenate((self.xSum_,np.zeros((x.shape[0],dK))),axis=1)
+    Nw, xSum, S = GroupedSums(x,zs,self.K,ws,self.scatter)
+    self.N_ += np.bincount(zs,minlength=self.K)
+    self.Nw_ += Nw
+    self.Nw2_ += np.bincount(zs,weights=ws**2,minlength=self.K)
+    self.xSum_ += xSum
+    if self.scatter:
+      self.S_ = np.concatenate((self.S_,np.zeros((dK,x.shape[0],x.shape[0]))),axis=0)
+      self.S_ += S
+    seen = self.Nw_ > 0
+    self.mus[:,seen] = self.xSum_[:,seen]/self.Nw_[seen]
+    return zs
+
+  def ComputeStream(self,chunks):
+    '''
+    Run PartialFit over an iterable (list, iterator or generator) of DxN_i
+    chunks or (chunk, weights) tuples.
+    '''
+    for chunk in chunks:
+      if isinstance(chunk,tuple):
+        self.PartialFit(*chunk)
+      else:
+        self.PartialFit(chunk)
+
+  def GetStreamClusterParameters(self):
+    '''
+    Counts, means and covariances of the clusters from the statistics
+    accumulated by PartialFit; small clusters are removed as in
+    GetClusterParameters.
+    '''
+    if not self.scatter:
+      raise ValueError('scatter matrices were not accumulated')
+    N = self.N_.sum()
+    Ns = self.Nw_.copy()
+    mus = self.xSum_/Ns
+    Ss = Covariances(Ns,mus,self.S_,self.Nw2_,self.N_)
+    # delete small clusters
+    idKeep = self.N_ > max(10,0.001*N)
+    print "threshold for cluster removal {}".format(max(10,0.001*N))
+    print "removing {} of {} clusters".format(self.K - idKeep.sum(),self.K)
+    mus = mus[:,idKeep]
+    Ns = Ns[idKeep]
+    Ss = [S for i,S in enumerate(Ss) if idKeep[i]]
+    return Ns, mus, Ss
+
+  def GetClusterParameters(self,xs, ws=None, countWeights=False):
     '''
     Compute the sufficient statistics in each cluster.
-    Optionally weights for each data point can be passed in.
+    Optionally weights for each data point can be passed in. With
+    countWeights the weights are numbers of data points (e.g. of a
+    coreset) which then also decide which clusters are too small.
     '''
     N = xs.shape[1]
+    Nw, xSums, S = GroupedSums(xs,self.zs,self.K,ws)
+    counts = self.N_
     if ws is None:
       # no weights passed in so use 1s
       ws = np.ones(N)
       Ns = self.N_.copy()
       mus = self.mus.copy()
     else:
-      mus = np.zeros((3,self.K))
-      Ns = np.zeros(self.K)
-      for k in range(self.K):
-        ids = self.zs == k
-        Ns[k] = np.sum(ws[ids])
-        mus[:,k] = np.sum(ws[ids]*xs[:,ids], axis=1)/Ns[k]
-    Ss = []
-    for k in range(self.K):
-      ids = self.zs==k
-#      if ids.sum() <= 0.1*N:
-#        continue # sort out very small clusters because they tend to
-#                 # make numeric difficulties 
-      # regularize
-      S = np.zeros((3,3))
-      Stilde = np.zeros((3,3))
-      for i,x in enumerate(xs[:,ids].T):
-        S += ws[ids][i]*np.outer(x,x)
-        Stilde += np.outer(x,x)
-#        Ss.append(np.identity(3)*1e-12+S/(Ns[k]-1.)-(Ns[k]/(Ns[k]-1.))*np.outer(mus[:,k],mus[:,k]))
-#        Ss.append(S/(Ns[k]-1.)-(Ns[k]/(Ns[k]-1.))*np.outer(mus[:,k],mus[:,k]))
-      if self.N_[k] > 1:
-        Ss.append((S-Ns[k]*np.outer(mus[:,k],mus[:,k]))/(Ns[k]-((ws[ids]**2).sum()/Ns[k])))
-      else:
-        Ss.append(np.identity(3)*1e6)
-      if False:
-        Nsk = ids.sum()
-        Stilde = Stilde/(Nsk-1.)-(Nsk/(Nsk-1.))*np.outer(self.mus[:,k],self.mus[:,k])
-        print '---', Ss[-1]
-        print Stilde
-        print Ss[-1]-Stilde
-        
-#      else:
-#        print "low number of data points in cluster ",k, ": ",Ns[k] 
-#        Ss.append(np.identity(3)*1e6)
-#      print Ns[k], mus[:,k]
-#      print Ss[k]
-
+      Ns = Nw
+      mus = xSums/Ns
+    if countWeights:
+      Nw2 = Ns # unbiased for repeated data points
+      counts = Ns
+      N = ws.sum()
+    else:
+      Nw2 = np.bincount(self.zs,weights=ws**2,minlength=self.K)
+    Ss = Covariances(Ns,mus,S,Nw2,counts)
     # delete small clusters
-    idKeep = self.N_ > max(10,0.001*N)
+    idKeep = counts > max(10,0.001*N)
     print "threshold for cluster removal {}".format(max(10,0.001*N))
     print "removing {} of {} clusters".format(self.K - idKeep.sum(),self.K)
     K = idKeep.sum()
@@ -1,135 +1,754 @@
 import numpy as np
+import ctypes
+import multiprocessing as mp
+from multiprocessing.sharedctypes import RawArray
 
 def norm(x):
   return np.sqrt((x**2).sum())
 def normed(x):
   return x/norm(x)
 
+def LangevinA3(tau):
+  '''
+  Mean resultant length coth(tau) - 1/tau of 3D vMF distributions with
+  concentrations tau and its derivative; series expansions for small tau.
+  '''
+  small = tau < 1e-3
+  t = np.where(small, 1., tau)
+  e = np.exp(-2.*t)
+  A = np.where(small, tau/3. - tau**3/45., (1.+e)/(1.-e) - 1./t)
+  dA = np.where(small, 1./3. - tau**2/15., 1./t**2 - 4.*e/(1.-e)**2)
+  return A, dA
+
 def MLestTau(mu, xSum, count):
-  tau = 1.0;                                                           
-  prevTau = 0.;                                                        
-  eps = 1e-8;                                                          
-  R = norm(xSum)/count;                                               
-  while np.abs(tau - prevTau) > eps:
-    inv_tanh_tau = 1./np.tanh(tau)
-    inv_tau = 1./tau
-    f = -inv_tau + inv_tanh_tau - R
-    df = inv_tau*inv_tau - inv_tanh_tau*inv_tanh_tau + 1.
-    prevTau = tau
-    tau -= f/df
-  return tau
-
-def FitMlDPvMFMM(ns, lamb, it=20, mu=None, ws=None):
-  dpMeans = DPvMFmeans(lamb, mu)
-  for i,n in enumerate(ns):
-    dpMeans.AddObservation(n)
+  '''
+  Maximum likelihood concentration of a 3D vMF distribution from the sum
+  and count of its data points; mu is not needed (see MLestTaus).
+  '''
+  return MLestTaus(xSum, count)
+
+def MLestTaus(xSum, count, fast=False):
+  '''
+  Maximum likelihood concentrations of 3D vMF distributions from the sums
+  (3 or Kx3) and counts of their data points. Starts from the closed form
+  approximation tau = R(3-R^2)/(1-R^2) of Banerjee et al. (returned with
+  fast) and runs Newton on coth(tau) - 1/tau = R for all K at once. The
+  mean resultant lengths R are clipped away from 0 and 1.
+  '''
+  xSum = np.asarray(xSum, dtype=np.float)
+  R = np.sqrt((np.atleast_2d(xSum)**2).sum(axis=1))/count
+  R = np.clip(R, 1e-12, 1.-1e-12)
+  tau = R*(3.-R**2)/(1.-R**2)
+  if not fast:
+    for it in range(100):
+      A, dA = LangevinA3(tau)
+      step = (A - R)/dA
+      # Newton on the concave A converges from below; do not overshoot
+      # below zero from above
+      tau = np.maximum(tau - step, 0.5*tau)
+      if (np.abs(step) <= 1e-8*np.maximum(1.,tau)).all():
+        break
+  return tau if xSum.ndim > 1 else tau[0]
+
+def FitMlDPvMFMM(ns, lamb, it=20, mu=None, ws=None, verbose=True,
+    minChange=0., capIndexLevel=None):
+  '''
+  Only the means of clusters that changed and the labels that can change
+  are updated in each iteration; stops once the cost does not increase
+  or at most a fraction minChange of the labels changed. With
+  capIndexLevel the closest means are looked up in a CapIndex (see
+  DPvMFmeans).
+  '''
+  dpMeans = DPvMFmeans(lamb, mu, capIndexLevel=capIndexLevel)
+  dpMeans.AddObservations(ns)
   f, fPrev = 0,0
+  changed, zsFrom = None, None
   for i in range(it):
-    dpMeans.UpdateMeans()
+    moved = dpMeans.UpdateMeansChanged(changed, zsFrom)
     fPrev = f
-    f = dpMeans.UpdateLabels()
+    f, changed, zsFrom = dpMeans.UpdateLabelsMoved(moved)
     K = dpMeans.mus.shape[0]
     Ns = np.bincount(dpMeans.zs,minlength=K).astype(np.float)
-    print "@{}: cost={:4f}\tK={}\tavg Ns: {:.2f}, range Ns: {} {}".format(i, 
-        f, K, np.mean(Ns), np.min(Ns), np.max(Ns))
+    if verbose:
+      print "@{}: cost={:4f}\tK={}\tavg Ns: {:.2f}, range Ns: {} {}\tchanged: {}".format(i, 
+          f, K, np.mean(Ns), np.min(Ns), np.max(Ns), changed.size)
+    if f-fPrev <= 0. or changed.size <= minChange*dpMeans.N:
+      break
+  Ns, mus, taus = dpMeans.GetClusterParameters(ws,verbose=verbose)
+  pi = Ns/float(Ns.sum())
+  return mus, taus, pi
+
+def FitMlDPvMFMMBinned(ns, lamb, level=3, it=20, refine=1, verbose=True):
+  '''
+  Like FitMlDPvMFMM but clustering the centers of the IcoSphere
+  triangles of the given level that the Nx3 normals ns fall into,
+  weighted by the number of normals in each triangle, so that an
+  iteration costs O(cells K) instead of O(N K). Afterwards refine
+  iterations on the raw normals start from the binned means; without
+  them the parameters are estimated from the weighted cell centers.
+  '''
+  from js.geometry.icosphere import IcoSphere
+  ico = IcoSphere(level)
+  cells = ico.GetTriangleIDsAtLevel(ns, level)
+  cells, counts = np.unique(cells, return_counts=True)
+  qs = ico.GetTriangleCentersAtLevel(level)[cells,:]
+  dpMeans = DPvMFmeans(lamb)
+  dpMeans.AddObservations(qs, counts.astype(np.float))
+  f, fPrev = 0,0
+  for i in range(it):
+    dpMeans.UpdateMeans()
+    fPrev = f
+    f = dpMeans.UpdateLabels()
+    if verbose:
+      print "@{}: cost={:4f}\tK={}\tcells={}".format(i, f,
+          dpMeans.mus.shape[0], cells.size)
     if f-fPrev <= 0.:
       break
-  Ns, mus, taus = dpMeans.GetClusterParameters(ws)
+  if refine > 0:
+    mus = dpMeans.mus
+    dpMeans = DPvMFmeans(lamb, mus)
+    dpMeans.AddObservations(ns)
+    for i in range(refine):
+      dpMeans.UpdateMeans()
+      dpMeans.UpdateLabels()
+    Ns, mus, taus = dpMeans.GetClusterParameters(verbose=verbose)
+  else:
+    Ns, mus, taus = dpMeans.GetClusterParameters(dpMeans.ws,
+        countWeights=True, verbose=verbose)
   pi = Ns/float(Ns.sum())
   return mus, taus, pi
 
-def logSumExp(a,pmFactors=None):
-  aMax = np.max(a)
-  if pmFactors is None:
-    return np.log((np.exp(a-aMax)).sum())+aMax
+_shared = {}
+def _InitFrameWorker(ns,bounds):
+  _shared['ns'] = None if ns is None else np.frombuffer(ns)
+  _shared['bounds'] = bounds
+
+def _FitFrame(args):
+  i,path,lamb,it = args
+  if path is None:
+    i0,i1 = _shared['bounds'][i]
+    ns = _shared['ns'][i0:i1]
   else:
-    return np.log((pmFactors*np.exp(a-aMax)).sum())+aMax
+    ns = np.load(path,mmap_mode='r')
+  ns = ns.reshape(-1,3)
+  return i, FitMlDPvMFMM(ns[np.isfinite(ns).all(axis=1)],lamb,it,
+      verbose=False)
+
+def FitMlDPvMFMMPool(frames, lamb, it=20, nWorkers=None):
+  '''
+  Fit DP-vMF mixtures to many frames of normals (arrays of shape Nx3 or
+  HxWx3; non-finite normals are skipped) or paths to .npy files of them
+  on a pool of nWorkers processes. Arrays are copied once into shared
+  memory and files are memory-mapped by the workers so that no normals
+  are pickled. Yields the frame index and mus, taus, pi of each frame as
+  soon as its fit finishes.
+  '''
+  frames = list(frames)
+  arrays = [i for i,f in enumerate(frames) if not isinstance(f,basestring)]
+  nsShared, bounds = None, {}
+  if len(arrays) > 0:
+    nsShared = RawArray(ctypes.c_double,sum(frames[i].size for i in arrays))
+    ns = np.frombuffer(nsShared)
+    i0 = 0
+    for i in arrays:
+      bounds[i] = (i0,i0+frames[i].size)
+      ns[i0:i0+frames[i].size] = frames[i].ravel()
+      i0 += frames[i].size
+  pool = mp.Pool(nWorkers,_InitFrameWorker,(nsShared,bounds))
+  try:
+    for i,res in pool.imap_unordered(_FitFrame,[(i,None if i in bounds else
+      f,lamb,it) for i,f in enumerate(frames)]):
+      yield (i,)+res
+  finally:
+    pool.terminate()
+    pool.join()
+
+def FitMlDPvMFMMFrames(frames, lamb, Q, tau, it=20, eps=1e-3):
+  '''
+  Fit a DP-vMF mixture to each Nx3 frame of normals of the iterable
+  frames where every frame is warm-started from the clusters of the
+  previous frames (see DPvMFmeans.ComputeTemporal). Yields mus, taus, pi
+  for each frame.
+  '''
+  dpMeans = DPvMFmeans(lamb)
+  for ns in frames:
+    dpMeans.ComputeTemporal(ns, Q, tau, it, eps)
+    Ns, mus, taus = dpMeans.GetClusterParameters()
+    pi = Ns/float(Ns.sum())
+    yield mus, taus, pi
+
+def logSumExp(a,pmFactors=None,axis=None):
+  '''
+  log(sum(pmFactors*exp(a))) over all entries or along axis; slices that
+  are all -inf give -inf.
+  '''
+  aMax = np.max(a,axis=axis,keepdims=True)
+  aMax[~np.isfinite(aMax)] = 0.
+  e = np.exp(a-aMax)
+  if not pmFactors is None:
+    e *= pmFactors
+  with np.errstate(divide='ignore'):
+    logS = np.log(e.sum(axis=axis,keepdims=True))+aMax
+  return logS.item() if axis is None else np.squeeze(logS,axis=axis)
 
 def log2SinhOverZ(z):
-  if z > 10:
-    logF =-np.log(z)+z
-  else:
-    logF =np.log(2.+z**2/3.+z**4/50.+z**6/2520.)
-  return logF
+  '''
+  log(2 sinh(z)/z) for scalar or array z > 0; a series for small z and
+  z + log(1-exp(-2z)) - log(z) otherwise which does not overflow.
+  '''
+  z = np.asarray(z,dtype=np.float)
+  small = z < 1e-3
+  t = np.where(small,1.,z)
+  logF = np.where(small, np.log(2.)+z**2/6., t+np.log1p(-np.exp(-2.*t))-np.log(t))
+  return logF if logF.ndim > 0 else logF.item()
 
 def logPdfDPvMFMM(mu,tau,pi,x):
-  K = tau.size
-  logPdfs = np.zeros(K)
-  for k in range(K):
-    logPdfs[k] = np.log(pi[k]) + mu[k,:].dot(x)*tau[k]\
-      -np.log(4.*np.pi) -log2SinhOverZ(tau[k])
-  return logSumExp(logPdfs)
+  ''' log density of the 3D vMF mixture (Kx3 mu, K tau, K pi) at x '''
+  return logPdfDPvMFMMBatch(mu,tau,pi,x[:,np.newaxis])[0]
+
+def logPdfDPvMFMMBatch(mu,tau,pi,x,responsibilities=False,chunkSize=4096):
+  '''
+  Log densities of the 3D vMF mixture (Kx3 mu, K tau, K pi) at all
+  points of the 3xN x (like logPdfDPvMFMM; pass ns.T for Nx3 normals) or
+  with responsibilities the KxN posterior probabilities of the
+  components. x is scored in chunks of chunkSize points.
+  '''
+  if x.ndim != 2 or x.shape[0] != 3:
+    raise ValueError('x has to be 3xN',x.shape)
+  N = x.shape[1]
+  # log(pi tau/(4 pi sinh(tau)))
+  logC = np.log(pi) - np.log(2.*np.pi) - log2SinhOverZ(tau)
+  out = np.zeros((tau.size,N)) if responsibilities else np.zeros(N)
+  for i0 in range(0,N,chunkSize):
+    i1 = min(i0+chunkSize,N)
+    logPdfs = (tau[:,np.newaxis]*mu).dot(x[:,i0:i1]) + logC[:,np.newaxis]
+    logPdf = logSumExp(logPdfs,axis=0)
+    if responsibilities:
+      out[:,i0:i1] = np.exp(logPdfs - logPdf[np.newaxis,:])
+    else:
+      out[i0:i1] = logPdf
+  return out
+
+def SelectOpeners(qs,lamb):
+  '''
+  Indices of the observations among the Nx3 qs (ordered as in the sweep)
+  that open a new cluster: like in the sequential sweep the first of
+  them does and each following one only does if no cluster opened
+  before it has a dot product above lamb.
+  '''
+  dotBest = np.ones(qs.shape[0])*-np.inf
+  openers = []
+  j = 0
+  while j < qs.shape[0]:
+    openers.append(j)
+    dotBest[j+1::] = np.maximum(dotBest[j+1::], qs[j+1::,:].dot(qs[j,:]))
+    jNext = np.where(dotBest[j+1::] <= lamb)[0]
+    if jNext.size == 0:
+      break
+    j += 1 + jNext[0]
+  return np.array(openers,dtype=np.int)
+
+def AssignToOpened(qs,z,dots,musNew,iOpen,K):
+  '''
+  Relabel the Nx3 observations qs with labels z and dot products dots
+  with their means against the clusters musNew which were opened by the
+  observations iOpen. A cluster is only available to the observations
+  after the one that opened it and gets the label K plus its index in
+  musNew. z and dots are updated in place.
+  '''
+  i0 = iOpen[0]
+  dotsNew = qs[i0::,:].dot(musNew.T)
+  dotsNew[np.arange(i0,qs.shape[0])[:,np.newaxis] < iOpen[np.newaxis,:]] \
+      = -np.inf
+  zNew = np.argmax(dotsNew,axis=1)
+  dotNew = dotsNew[np.arange(zNew.size),zNew]
+  # on ties the sequential argmax prefers the existing clusters
+  closer = dotNew > dots[i0::]
+  z[i0::][closer] = K + zNew[closer]
+  dots[i0::][closer] = dotNew[closer]
+  z[iOpen] = K + np.arange(iOpen.size)
+
+class CapIndex(object):
+  '''
+  Index of the means of DP-vMF-means over the triangles of an IcoSphere
+  of the given level. An observation q can only join a mean within the
+  spherical cap of angular radius arccos(lamb) around q. Means and
+  observations are bucketed by the closest triangle center and the
+  triangle inequality with the actual angles to the bucket centers
+  rules out whole buckets of means for all observations of a bucket.
+  '''
+  def __init__(self, lamb, level=1):
+    from js.geometry.icosphere import IcoSphere
+    self.centers = IcoSphere(level).GetTriangleCentersAtLevel(level)
+    self.A = np.arccos(np.clip(self.centers.dot(self.centers.T),-1.,1.))
+    self.theta = np.arccos(np.clip(lamb,-1.,1.))
+    self.Build(np.zeros((0,3)))
+  def Bucket(self, qs):
+    ''' closest triangle centers of the Nx3 qs and the angles to them '''
+    dots = qs.dot(self.centers.T)
+    cells = np.argmax(dots,axis=1)
+    return cells, np.arccos(np.clip(dots[np.arange(cells.size),cells],-1.,1.))
+  def Build(self, mus):
+    ''' (Re)index the Kx3 means mus, e.g. after they moved '''
+    self.mus = mus.copy()
+    self.cells, self.rads = self.Bucket(self.mus)
+    # largest angle of a mean to the center of its bucket
+    self.Rm = np.ones(self.centers.shape[0])*-np.inf
+    np.maximum.at(self.Rm,self.cells,self.rads)
+  def Add(self, musNew):
+    ''' Index the new means musNew appended after the current ones '''
+    cells, rads = self.Bucket(musNew)
+    self.mus = np.r_[self.mus, musNew]
+    self.cells = np.r_[self.cells, cells]
+    self.rads = np.r_[self.rads, rads]
+    np.maximum.at(self.Rm,cells,rads)
+  def Best(self, qs):
+    '''
+    Labels and dot products of the closest means of the Nx3 qs among the
+    means that can have a dot product above lamb. Observations without
+    any such candidate get a dot product of -inf.
+    '''
+    cellsQ, radsQ = self.Bucket(qs)
+    z = np.zeros(qs.shape[0], dtype=np.int)
+    dots = np.ones(qs.shape[0])*-np.inf
+    order = np.argsort(cellsQ,kind='mergesort')
+    bounds = np.r_[0,np.cumsum(np.bincount(cellsQ,
+      minlength=self.centers.shape[0]))]
+    for a in np.where(bounds[1::] > bounds[:-1])[0]:
+      ids = order[bounds[a]:bounds[a+1]]
+      near = self.A[a,:] < self.theta + radsQ[ids].max() + self.Rm + 1e-9
+      cand = np.where(near[self.cells])[0]
+      if cand.size == 0:
+        continue
+      dotsC = qs[ids,:].dot(self.mus[cand,:].T)
+      j = np.argmax(dotsC,axis=1)
+      z[ids] = cand[j]
+      dots[ids] = dotsC[np.arange(ids.size),j]
+    return z, dots
 
 class DPvMFmeans(object):
-  def __init__(self, lamb, mu=None):
+  def __init__(self, lamb, mu=None, chunkSize=4096, capIndexLevel=None):
+    '''
+    With capIndexLevel the closest means are looked up in a CapIndex over
+    the triangles of an IcoSphere of that level.
+    '''
     self.lamb = lamb
+    self.chunkSize = chunkSize
     if mu is None:
       self.mus = np.zeros((0,3))
     else:
       self.mus = mu
-    self.qs = np.zeros((0,3))
-    self.zs = np.zeros(0, dtype=np.int)
-  def AddObservation(self, q):
+    self.index = None
+    if not capIndexLevel is None:
+      self.index = CapIndex(lamb, capIndexLevel)
+      self.index.Build(self.mus)
+    # observations live in buffers whose capacity doubles when full;
+    # qs, zs and ws are views of the used part
+    self.N = 0
+    self.qsBuf = np.zeros((0,3))
+    self.zsBuf = np.zeros(0, dtype=np.int)
+    self.wsBuf = np.zeros(0)
+    self.dotsBuf = np.zeros(0)
+    self.SetViews()
+  def SetViews(self):
+    self.qs = self.qsBuf[:self.N,:]
+    self.zs = self.zsBuf[:self.N]
+    self.ws = self.wsBuf[:self.N]
+    # dot products of the observations with their means
+    self.dots = self.dotsBuf[:self.N]
+  def Reserve(self, N):
+    ''' Make room for at least N observations in total. '''
+    cap = self.zsBuf.size
+    if N <= cap:
+      return
+    cap = max(N, 2*cap)
+    qsBuf = np.zeros((cap,3))
+    zsBuf = np.zeros(cap, dtype=np.int)
+    wsBuf = np.zeros(cap)
+    dotsBuf = np.zeros(cap)
+    qsBuf[:self.N,:] = self.qs
+    zsBuf[:self.N] = self.zs
+    wsBuf[:self.N] = self.ws
+    dotsBuf[:self.N] = self.dots
+    self.qsBuf, self.zsBuf, self.wsBuf = qsBuf, zsBuf, wsBuf
+    self.dotsBuf = dotsBuf
+    self.SetViews()
+  def AddObservation(self, q, w=1.):
     ''' 
-    Add an observation q to the set of observations. Assigns a label to
-    that new observation and returns the label.
-    '''
-#    print self.qs.shape, q.shape, q[np.newaxis,:].shape
-#    print self.zs.shape, z.shape, z[np.newaxis,:].shape
-    self.qs = np.r_[self.qs, q[np.newaxis,:]]
-    self.zs = np.r_[self.zs, np.array([self.ComputeLabel(q)[0]])]
-    return self.zs[-1]
+    Add an observation q with weight w (e.g. the number of observations
+    it stands for in a coreset) to the set of observations. Assigns a
+    label to that new observation and returns the label.
+    '''
+    return self.AddObservations(q[np.newaxis,:],np.array([w]))[0]
+  def AddObservations(self, Q, ws=None):
+    '''
+    Add the Nx3 observations Q with optional weights ws to the set of
+    observations. Assigns labels to the new observations in the order of
+    Q as repeated calls to AddObservation would and returns them.
+    '''
+    i0 = self.N
+    self.Reserve(i0+Q.shape[0])
+    self.N = i0+Q.shape[0]
+    self.qsBuf[i0:self.N,:] = Q
+    self.wsBuf[i0:self.N] = 1. if ws is None else ws
+    self.SetViews()
+    self.LabelObservations(i0,self.N)
+    return self.zs[i0::]
+  def LabelObservations(self, i0, i1):
+    '''
+    Label the observations i0 to i1 in chunks of chunkSize against the
+    current means, opening new clusters in the same order as the
+    sequential ComputeLabel. Returns the weighted cost of the labels.
+    '''
+    f = 0.
+    for j0 in range(i0,i1,self.chunkSize):
+      j1 = min(j0+self.chunkSize,i1)
+      qc = self.qs[j0:j1,:]
+      K = self.mus.shape[0]
+      if K > 0 and not self.index is None:
+        # only far observations can get a dot product short of their
+        # best one which does not change their labels
+        z, dots = self.index.Best(qc)
+      elif K > 0:
+        dots = qc.dot(self.mus.T)
+        z = np.argmax(dots,axis=1)
+        dots = dots[np.arange(j1-j0),z]
+      else:
+        z = np.zeros(j1-j0, dtype=np.int)
+        dots = np.ones(j1-j0)*-np.inf
+      far = np.where(dots <= self.lamb)[0]
+      if far.size > 0:
+        iOpen = far[SelectOpeners(qc[far,:],self.lamb)]
+        musNew = qc[iOpen,:].copy()
+        AssignToOpened(qc,z,dots,musNew,iOpen,K)
+        dots[iOpen] = (qc[iOpen,:]*musNew).sum(axis=1)
+        self.mus = np.r_[self.mus, musNew]
+        if not self.index is None:
+          self.index.Add(musNew)
+      self.zs[j0:j1] = z
+      self.dots[j0:j1] = dots
+      f += self.ws[j0:j1].dot(dots)
+      if far.size > 0:
+        # as for repeated observations the one that opens a new cluster
+        # scores lamb and the rest of its weight the dot product
+        f += (self.lamb - dots[iOpen]).sum()
+    return f
+  def UpdateMeansChanged(self, changed=None, zsFrom=None):
+    '''
+    Update the means from per cluster sums which are kept up to date with
+    the observations changed that left the clusters zsFrom (all
+    observations if changed is None). Only the means of clusters that
+    gained or lost observations are recomputed. Empty and singleton
+    clusters are removed as in UpdateMeans. Returns the boolean mask of
+    the means that moved.
+    '''
+    K = self.mus.shape[0]
+    if changed is None:
+      self.Ns = np.bincount(self.zs,minlength=K)
+      self.Ws = np.bincount(self.zs,weights=self.ws,minlength=K)
+      self.xSums = np.zeros((K,3))
+      for d in range(3):
+        self.xSums[:,d] = np.bincount(self.zs,weights=self.ws*self.qs[:,d],
+            minlength=K)
+      moved = np.ones(K, dtype=np.bool)
+    else:
+      # clusters opened by the last UpdateLabelsMoved
+      Kp = self.Ns.size
+      self.Ns = np.r_[self.Ns, np.zeros(K-Kp, dtype=np.int)]
+      self.Ws = np.r_[self.Ws, np.zeros(K-Kp)]
+      self.xSums = np.r_[self.xSums, np.zeros((K-Kp,3))]
+      zsTo = self.zs[changed]
+      wqs = self.ws[changed,np.newaxis]*self.qs[changed,:]
+      np.subtract.at(self.Ns, zsFrom, 1)
+      np.add.at(self.Ns, zsTo, 1)
+      np.subtract.at(self.Ws, zsFrom, self.ws[changed])
+      np.add.at(self.Ws, zsTo, self.ws[changed])
+      np.subtract.at(self.xSums, zsFrom, wqs)
+      np.add.at(self.xSums, zsTo, wqs)
+      moved = self.stale.copy()
+      moved = np.r_[moved, np.zeros(K-Kp, dtype=np.bool)]
+      moved[zsFrom] = True
+      moved[zsTo] = True
+    keep = (self.Ns > 1) | (self.Ws > 1.)
+    if not keep.any():
+      keep = self.Ns > 0
+    ks = moved & keep
+    self.mus[ks,:] = self.xSums[ks,:] \
+        /np.sqrt((self.xSums[ks,:]**2).sum(axis=1))[:,np.newaxis]
+    self.stale = np.zeros(keep.sum(), dtype=np.bool)
+    if not keep.all():
+      lost = np.where(~keep[self.zs])[0]
+      self.zs[:] = (np.cumsum(keep)-1)[self.zs]
+      self.mus, self.Ns, self.xSums = self.mus[keep,:], self.Ns[keep], \
+          self.xSums[keep,:]
+      self.Ws = self.Ws[keep]
+      moved = moved[keep]
+      if lost.size > 0:
+        # observations of removed clusters join the closest mean which
+        # is only recomputed with them on the next call
+        dots = self.qs[lost,:].dot(self.mus.T)
+        z = np.argmax(dots,axis=1)
+        self.zs[lost] = z
+        self.dots[lost] = dots[np.arange(z.size),z]
+        np.add.at(self.Ns, z, 1)
+        np.add.at(self.Ws, z, self.ws[lost])
+        np.add.at(self.xSums, z, self.ws[lost,np.newaxis]*self.qs[lost,:])
+        self.stale[z] = True
+        moved[z] = True
+    if not self.index is None:
+      self.index.Build(self.mus)
+    return moved
+  def UpdateLabelsMoved(self, moved):
+    '''
+    Recompute labels and the (weighted) cost after only the means in the
+    boolean mask moved changed (see UpdateMeansChanged): observations of
+    moved clusters are compared with all means (only with the candidates
+    of the CapIndex if there is one) and all others only with the moved
+    ones. New clusters are opened as in UpdateLabels. Returns
+    the cost, the indices of the observations that changed their label
+    and their previous labels.
+    '''
+    K = self.mus.shape[0]
+    zsPrev = self.zs.copy()
+    km = np.where(moved)[0]
+    for j0 in range(0,self.N,self.chunkSize):
+      j1 = min(j0+self.chunkSize,self.N)
+      qc, zc, dc = self.qs[j0:j1,:], self.zs[j0:j1], self.dots[j0:j1]
+      own = np.where(moved[zc])[0]
+      if own.size > 0 and not self.index is None:
+        # as in LabelObservations only far observations can miss their
+        # best mean and they open or join new clusters below
+        zc[own], dc[own] = self.index.Best(qc[own,:])
+      elif own.size > 0:
+        dots = qc[own,:].dot(self.mus.T)
+        z = np.argmax(dots,axis=1)
+        zc[own] = z
+        dc[own] = dots[np.arange(z.size),z]
+      others = np.where(~moved[zc])[0]
+      if km.size > 0 and others.size > 0:
+        dots = qc[others,:].dot(self.mus[km,:].T)
+        j = np.argmax(dots,axis=1)
+        d = dots[np.arange(j.size),j]
+        # on ties the sequential argmax prefers the lower label
+        better = (d > dc[others]) | ((d == dc[others]) & (km[j] < zc[others]))
+        zc[others[better]] = km[j[better]]
+        dc[others[better]] = d[better]
+    f = self.ws.dot(self.dots)
+    far = np.where(self.dots <= self.lamb)[0]
+    if far.size > 0:
+      iOpen = far[SelectOpeners(self.qs[far,:],self.lamb)]
+      musNew = self.qs[iOpen,:].copy()
+      AssignToOpened(self.qs,self.zs,self.dots,musNew,iOpen,K)
+      self.dots[iOpen] = (self.qs[iOpen,:]*musNew).sum(axis=1)
+      self.mus = np.r_[self.mus, musNew]
+      if not self.index is None:
+        self.index.Add(musNew)
+      f = self.ws.dot(self.dots) + (self.lamb - self.dots[iOpen]).sum()
+    changed = np.where(self.zs != zsPrev)[0]
+    return f, changed, zsPrev[changed]
   def ComputeLabel(self, q):
     ''' Computes the label for a given observation '''
     if self.mus.shape[0] == 0:
       self.mus = np.copy(q)[np.newaxis,:]
+      if not self.index is None:
+        self.index.Build(self.mus)
       return 0, self.lamb
-    dots = self.mus.dot(q)
-    if dots.max() > self.lamb:
-      return np.argmax(dots), dots.max() 
+    if self.index is None:
+      dots = self.mus.dot(q)
+      z, dot = np.argmax(dots), dots.max()
+    else:
+      z, dot = self.index.Best(q[np.newaxis,:])
+      z, dot = z[0], dot[0]
+    if dot > self.lamb:
+      return z, dot
     else:
       self.mus = np.r_[self.mus, q[np.newaxis,:]]
-      return dots.size, self.lamb
+      if not self.index is None:
+        self.index.Add(q[np.newaxis,:])
+      return self.mus.shape[0]-1, self.lamb
   def UpdateMeans(self):
-    ''' Update means of current observation set '''
-    for k in range(self.mus.shape[0]):
-      self.mus[k,:] = normed(self.qs[self.zs==k,:].sum(axis=0))
-    #TODO: remove single data point clusters
+    '''
+    Update means of current observation set from one grouped sum over
+    all observations. Empty clusters and (unless there are no others)
+    clusters of a single observation of weight at most 1 are removed and
+    the labels compacted, as for repeated observations; observations of removed clusters get the label of the
+    closest remaining mean until the next UpdateLabels.
+    '''
+    K = self.mus.shape[0]
+    Ns = np.bincount(self.zs,minlength=K)
+    Ws = np.bincount(self.zs,weights=self.ws,minlength=K)
+    xSums = np.zeros((K,3))
+    for d in range(3):
+      xSums[:,d] = np.bincount(self.zs,weights=self.ws*self.qs[:,d],
+          minlength=K)
+    keep = (Ns > 1) | (Ws > 1.)
+    if not keep.any():
+      keep = Ns > 0
+    self.mus = xSums[keep,:]/np.sqrt((xSums[keep,:]**2).sum(axis=1))[:,np.newaxis]
+    lost = ~keep[self.zs]
+    self.zs[:] = (np.cumsum(keep)-1)[self.zs]
+    if lost.any():
+      self.zs[lost] = np.argmax(self.qs[lost,:].dot(self.mus.T),axis=1)
+    if not self.index is None:
+      self.index.Build(self.mus)
   def UpdateLabels(self):
-    ''' Recompute labels and cost function '''
+    '''
+    Recompute labels and (weighted) cost function in one chunked pass of
+    matrix products with the means.
+    '''
+    return self.LabelObservations(0,self.N)
+  def SetPrior(self, mus, Ns, ages=None):
+    '''
+    Set the clusters (Kx3 means and weights) that ComputeTemporal
+    warm-starts from; ages are the numbers of frames since each cluster
+    was last observed (0 for clusters of the previous frame).
+    '''
+    K = Ns.size
+    self.priorMus = mus.copy()
+    self.priorWs = Ns.astype(np.float)
+    self.priorAges = np.zeros(K) if ages is None else ages.astype(np.float)
+    self.priorIds = np.arange(K)
+    self.nextId = K
+  def ComputeTemporal(self, ns, Q, tau, Tmax=100, eps=1e-3):
+    '''
+    Dynamic DP-vMF-means on the Nx3 frame of normals ns, warm-started
+    from the clusters of the previous frames (see SetPrior; the first
+    frame starts empty). As in DP-vMF-means a new cluster scores lamb. A
+    cluster last observed age frames ago can be revived at a penalty of
+    Q*age; its mean is pulled towards the old one with weight
+    gamma = 1/(1/w + tau*age) where w is its accumulated weight, so an
+    observation q scores |gamma*mu + q| - gamma - Q*age for reviving it.
+    Clusters that could no longer beat a new cluster are forgotten which
+    bounds the memory to the clusters of the last (1-lamb)/Q frames; the
+    observations of a frame replace the previous ones in the buffers.
+    Iterations stop once the objective increases by less than a fraction
+    eps. Afterwards mus and zs describe the clusters observed in ns and
+    ids holds their identities across frames.
+    '''
+    if not hasattr(self,'priorMus'):
+      self.SetPrior(np.zeros((0,3)),np.zeros(0))
+    Ko = self.priorWs.size
+    ages = self.priorAges + 1.
+    gammas = 1./(1./self.priorWs + tau*ages)
+    self.N = 0
+    self.Reserve(ns.shape[0])
+    self.N = ns.shape[0]
+    self.qsBuf[:self.N,:] = ns
+    self.wsBuf[:self.N] = 1.
+    self.SetViews()
+    self.mus = self.priorMus.copy()
+    obs = np.zeros(Ko, dtype=np.bool)
+    g, phis = gammas, self.priorMus
     f = 0.
-    for i in range(self.qs.shape[0]):
-      self.zs[i], df = self.ComputeLabel(self.qs[i,:])
-      f += df
+    for t in range(Tmax):
+      self.TemporalLabelObservations(obs, gammas, Q*ages)
+      # mean update
+      K = self.mus.shape[0]
+      Ns = np.bincount(self.zs,minlength=K)
+      g = np.r_[gammas,np.zeros(K-Ko)]
+      phis = np.r_[self.priorMus,np.zeros((K-Ko,3))]
+      xSums = g[:,np.newaxis]*phis
+      for d in range(3):
+        xSums[:,d] += np.bincount(self.zs,weights=self.qs[:,d],minlength=K)
+      obs = Ns > 0
+      self.mus[obs,:] = xSums[obs,:] \
+          /np.sqrt((xSums[obs,:]**2).sum(axis=1))[:,np.newaxis]
+      self.mus[~obs,:] = phis[~obs,:]
+      # new clusters that lost all their observations are removed
+      keep = obs | (np.arange(K) < Ko)
+      self.zs[:] = (np.cumsum(keep)-1)[self.zs]
+      self.mus, Ns, obs = self.mus[keep,:], Ns[keep], obs[keep]
+      g, xSums = g[keep], xSums[keep,:]
+      # objective
+      fPrev = f
+      f = (xSums[obs,:]*self.mus[obs,:]).sum() - g[obs].sum() \
+          - Q*ages[obs[:Ko]].sum() + self.lamb*(self.mus.shape[0]-Ko)
+      if t > 0 and f <= fPrev + eps*np.abs(fPrev):
+        break
+    # carry the clusters over to the next frame
+    K = self.mus.shape[0]
+    ws = np.r_[self.priorWs,np.zeros(K-Ko)]
+    ws[obs] = g[obs] + Ns[obs]
+    ages = np.r_[ages,np.zeros(K-Ko)]
+    ages[obs] = 0.
+    ids = np.r_[self.priorIds,self.nextId+np.arange(K-Ko)]
+    self.nextId += K-Ko
+    alive = 1. - Q*(ages+1.) > self.lamb
+    self.priorMus = self.mus[alive,:]
+    self.priorWs, self.priorAges, self.priorIds = ws[alive], ages[alive], ids[alive]
+    # expose only the clusters observed in this frame
+    self.zs[:] = (np.cumsum(obs)-1)[self.zs]
+    self.mus, self.ids = self.mus[obs,:], ids[obs]
+    if not self.index is None:
+      self.index.Build(self.mus)
     return f
-  def GetClusterParameters(self, ws=None):
+  def TemporalLabelObservations(self, obs, gammas, penalties):
+    '''
+    Label all observations in chunks where the first gammas.size means
+    are old clusters; those not observed (obs) in the current frame score
+    |gamma*mu + q| - gamma - penalty instead of the dot product. New
+    clusters are opened as in LabelObservations.
+    '''
+    Ko = gammas.size
+    rev = np.where(~obs[:Ko])[0]
+    g, pen = gammas[rev], penalties[rev]
+    for j0 in range(0,self.N,self.chunkSize):
+      j1 = min(j0+self.chunkSize,self.N)
+      qc = self.qs[j0:j1,:]
+      K = self.mus.shape[0]
+      if K > 0:
+        dots = qc.dot(self.mus.T)
+        dots[:,rev] = np.sqrt(np.maximum(g**2 + 2.*g*dots[:,rev] + 1.,0.)) \
+            - g - pen
+        z = np.argmax(dots,axis=1)
+        dots = dots[np.arange(j1-j0),z]
+      else:
+        z = np.zeros(j1-j0, dtype=np.int)
+        dots = np.ones(j1-j0)*-np.inf
+      far = np.where(dots <= self.lamb)[0]
+      if far.size > 0:
+        iOpen = far[SelectOpeners(qc[far,:],self.lamb)]
+        musNew = qc[iOpen,:].copy()
+        AssignToOpened(qc,z,dots,musNew,iOpen,K)
+        self.mus = np.r_[self.mus, musNew]
+      self.zs[j0:j1] = z
+  def GetClusterParameters(self, ws=None, countWeights=False, fastTau=False,
+      verbose=True):
+    '''
+    With countWeights the weights ws are numbers of observations (e.g. of
+    a coreset) which then also decide which clusters are too small. With
+    fastTau the concentrations are only approximated (see MLestTaus).
+    '''
     N = self.qs.shape[0]
     K = self.mus.shape[0]
+    xSums = np.zeros((K,3))
     if ws is None:
       # no weights passed in so use 1s
       ws = np.ones(N)
       mus = self.mus.copy()
       Ns = np.bincount(self.zs,minlength=K).astype(np.float)
+      for d in range(3):
+        xSums[:,d] = np.bincount(self.zs,weights=self.qs[:,d],minlength=K)
     else:
-      mus = np.zeros((K,3))
-      Ns = np.zeros(K)
-      for k in range(K):
-        ids = self.zs == k
-        Ns[k] = np.sum(ws[ids])
-        mus[k,:] = normed((ws[ids]*self.qs[ids,:].T).sum(axis=1))
-    print K, Ns
-    taus = np.zeros(K)
-    for k in range(K):
-      ids = self.zs == k
-      if Ns[k] <= 1.:
-        taus[k] = 1e-12
-      else:
-        taus[k] = MLestTau(mus[k,:],(ws[ids]*self.qs[ids,:].T).sum(axis=1),Ns[k])
+      Ns = np.bincount(self.zs,weights=ws,minlength=K)
+      for d in range(3):
+        xSums[:,d] = np.bincount(self.zs,weights=ws*self.qs[:,d],minlength=K)
+      mus = xSums/np.sqrt((xSums**2).sum(axis=1))[:,np.newaxis]
+    if verbose:
+      print K, Ns
+    taus = np.ones(K)*1e-12
+    ks = Ns > 1.
+    if ks.any():
+      taus[ks] = MLestTaus(xSums[ks,:],Ns[ks],fastTau)
 
     self.N_ = np.bincount(self.zs,minlength=K).astype(np.float)
+    if countWeights:
+      self.N_ = Ns
+      N = ws.sum()
     idKeep = self.N_ > max(10,0.001*N)
-    print "threshold for cluster removal {}".format(max(10,0.001*N))
-    print "removing {} of {} clusters".format(K - idKeep.sum(),K)
+    if verbose:
+      print "threshold for cluster removal {}".format(max(10,0.001*N))
+      print "removing {} of {} clusters".format(K - idKeep.sum(),K)
     K = idKeep.sum()
     mus = mus[idKeep,:]
     Ns = Ns[idKeep]
@@ -0,0 +1,48 @@
+import numpy as np
+from js.utils.timing import StopWatch
+from js.distributions.sampling import choice, choiceMult, AliasTable
+from js.distributions.distributions import Cat
+
+def choiceMask(p,n):
+  # previous choice: one mask over the cdf per sample
+  P = np.zeros(p.size+1)
+  P[1::] = np.cumsum(p)
+  ind = np.arange(P.size,dtype=np.int32)
+  x = np.random.rand(n)
+  return np.array([np.max(ind[P<=x[i]]) for i in xrange(n)],dtype=np.int32)
+
+def choiceMultMask(p):
+  # previous choiceMult: one mask over the cdf per row
+  P = np.zeros((p.shape[0],p.shape[1]+1))
+  P[:,1::] = np.cumsum(p,axis=1)
+  ind = np.arange(P.shape[1],dtype=np.int32)
+  x = np.random.rand(P.shape[0])
+  return np.array([np.max(ind[P[i,:]<=x[i]]) for i in xrange(P.shape[0])],
+      dtype=np.int32)
+
+def catMultinomial(pmf,n):
+  # previous Cat.sample: one multinomial draw per sample
+  return np.array([int(np.where(np.random.multinomial(1, pmf))[0][0]) for
+    i in xrange(n)])
+
+def Time(f,*args):
+  sw = StopWatch(False)
+  f(*args)
+  return sw.toc()
+
+if __name__=="__main__":
+  np.random.seed(1)
+  n = 10000
+  print 'K\tmask [s]\tmultinomial [s]\tsearchsorted [s]\talias [s]\tcat [s]'
+  for K in [10, 100, 1000, 10000]:
+    p = np.random.rand(K)
+    p /= p.sum()
+    cat = Cat(p)
+    print '{}\t{:.4f}\t{:.4f}\t{:.4f}\t{:.4f}\t{:.4f}'.format(K,
+        Time(choiceMask,p,n), Time(catMultinomial,p,n), Time(choice,p,n),
+        Time(lambda: AliasTable(p).sample(n)), Time(cat.sample,n))
+  print 'N\tK\tmask [s]\tvectorized [s]'
+  for N,K in [(10000,10), (10000,100), (100000,30)]:
+    p = np.random.rand(N,K)
+    print '{}\t{}\t{:.4f}\t{:.4f}'.format(N,K,Time(choiceMultMask,p),
+        Time(choiceMult,p))
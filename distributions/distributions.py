@@ -2,7 +2,7 @@
 import math
 import numpy as np
 from scipy.special import gammaln, multigammaln
-from scipy.linalg import inv, sqrtm
+from scipy.linalg import inv, solve_triangular
 
 from sampling import sample_invwishart
 
@@ -39,12 +39,8 @@ class Dir(object):
     if z.size >0:
       n_k = np.bincount(z,minlength=s.alpha.size) 
     else:
-      n_k = np.zeros(s.alpha.size)
-    #print n_k
-    #print s.alpha
-    logP = gammaln(np.sum(s.alpha)) - gammaln(np.sum(s.alpha+n_k))
-    logP += np.sum(gammaln(s.alpha+n_k) - gammaln(s.alpha))
-    return logP
+      n_k = np.zeros(s.alpha.size,dtype=np.int)
+    return s.logMarginalLikelihoodCounts(n_k)
 
   def logMarginalPosterior(s,z):
     '''
@@ -52,8 +48,68 @@ class Dir(object):
     where Z is a set of observations
     '''
     n_k = np.bincount(z,minlength=s.alpha.size)
-    logP_z = np.log(s.alpha+n_k)- np.log((s.alpha+n_k).sum()-1)
-    return logP_z
+    return s.logMarginalPosteriorCounts(n_k)
+
+  def gammalnAlpha(s,n):
+    '''
+    gammaln(alpha+m) (Kxn) for the integers m = 0 to n-1 from a cache
+    whose width doubles as needed; only the new columns are computed
+    '''
+    if not hasattr(s,'lgAlpha'):
+      s.lgAlpha = np.zeros((s.alpha.size,0))
+    cap = s.lgAlpha.shape[1]
+    if cap < n:
+      m = np.arange(cap,max(n,2*cap,16))
+      s.lgAlpha = np.concatenate((s.lgAlpha,
+        gammaln(s.alpha[:,np.newaxis] + m)),axis=1)
+    return s.lgAlpha
+
+  def gammalnAlphaSum(s,n):
+    '''
+    gammaln(sum(alpha)+m) for the integers m = 0 to n-1 from a cache
+    that grows like the one of gammalnAlpha
+    '''
+    if not hasattr(s,'lgAlphaSum'):
+      s.lgAlphaSum = np.zeros(0)
+    cap = s.lgAlphaSum.size
+    if cap < n:
+      m = np.arange(cap,max(n,2*cap,16))
+      s.lgAlphaSum = np.r_[s.lgAlphaSum, gammaln(s.alpha.sum() + m)]
+    return s.lgAlphaSum
+
+  def logMarginalLikelihoodCounts(s,n_k):
+    '''
+    dirichlet multinomial of the integer counts n_k with gammaln looked up
+    in the caches of gammalnAlpha (sized by the largest count) and
+    gammalnAlphaSum (sized by the total count)
+    '''
+    n_k = np.asarray(n_k,dtype=np.int)
+    N = n_k.sum()
+    lgAlpha = s.gammalnAlpha(n_k.max()+1)
+    lgAlphaSum = s.gammalnAlphaSum(N+1)
+    logP = lgAlphaSum[0] - lgAlphaSum[N]
+    logP += np.sum(lgAlpha[np.arange(n_k.size),n_k] - lgAlpha[:,0])
+    return logP
+
+  def logMarginalPosteriorCounts(s,n_k):
+    ''' logMarginalPosterior from the counts n_k '''
+    return np.log(s.alpha+n_k)- np.log((s.alpha+n_k).sum()-1)
+
+  def deltaLogMarginalLikelihood(s,n_k,kFrom,kTo):
+    '''
+    change of logMarginalLikelihoodCounts(n_k) in O(1) when one indicator
+    moves from component kFrom to kTo; n_k are the counts before the move
+    '''
+    if kFrom == kTo:
+      return 0.
+    return np.log(s.alpha[kTo]+n_k[kTo]) - np.log(s.alpha[kFrom]+n_k[kFrom]-1.)
+
+  def deltaLogMarginalLikelihoodAdd(s,n_k,k,N):
+    '''
+    change of logMarginalLikelihoodCounts(n_k) in O(1) when an indicator
+    for component k is added to the N = sum(n_k) indicators
+    '''
+    return np.log(s.alpha[k]+n_k[k]) - np.log(s.alpha.sum()+N)
   def marginalBeta(self,j):
     '''
     returns the marginal distribution when integrating over all but the jth pi 
@@ -69,8 +125,12 @@ class Cat(object):
   '''
   def __init__(self,pmf):
     self.pmf = pmf
-  def sample(self):
-    return int(np.where(np.random.multinomial(1, self.pmf))[0][0])
+    self.cdf = np.cumsum(pmf)
+  def sample(self,n=None):
+    ''' one sample or n samples by binary search in the cdf '''
+    x = np.random.rand(1 if n is None else n)*self.cdf[-1]
+    c = np.searchsorted(self.cdf,x,side='right')
+    return int(c[0]) if n is None else c
 
 
 class Beta(object):
@@ -84,6 +144,62 @@ class Beta(object):
     logP -= gammaln(self.alpha) + gammaln(self.beta)
     return logP
   
+def cholUpdate(L, x, sign=1.):
+  '''
+  Turn the lower Cholesky factor L of A into the one of A + sign*x*x^T
+  in place in O(d^2).
+  '''
+  x = np.array(x, dtype=np.float)
+  d = x.size
+  for k in range(d):
+    r2 = L[k,k]**2 + sign*x[k]**2
+    if r2 <= 0.:
+      raise ValueError('downdate makes the matrix indefinite')
+    r = np.sqrt(r2)
+    c, s = r/L[k,k], x[k]/L[k,k]
+    L[k,k] = r
+    L[k+1:,k] = (L[k+1:,k] + sign*s*x[k+1:])/c
+    x[k+1:] = c*x[k+1:] - s*L[k+1:,k]
+  return L
+
+class SuffStats(object):
+  '''
+  Sufficient statistics of data points (count, sum and scatter) together
+  with the Cholesky factor of delta + scatter which rank-1 updates and
+  downdates keep up to date, so that adding or removing a data point
+  costs O(d^2). Created by IW.suffStats and NIW.suffStats.
+  '''
+  def __init__(self, delta, x=None):
+    self.delta = delta
+    d = delta.shape[0]
+    self.n = 0
+    self.xSum = np.zeros(d)
+    self.scatter = np.zeros((d,d))
+    if not x is None and x.size > 0:
+      self.n = x.shape[1]
+      self.xSum = x.sum(axis=1)
+      self.scatter = np.dot(x,x.T)
+    self.L = np.linalg.cholesky(delta + self.scatter)
+  def copy(self):
+    ss = SuffStats.__new__(SuffStats)
+    ss.delta, ss.n = self.delta, self.n
+    ss.xSum, ss.scatter, ss.L = self.xSum.copy(), self.scatter.copy(), \
+        self.L.copy()
+    return ss
+  def add(self, x):
+    self.n += 1
+    self.xSum += x
+    self.scatter += np.outer(x,x)
+    cholUpdate(self.L, x)
+  def remove(self, x):
+    self.n -= 1
+    self.xSum -= x
+    self.scatter -= np.outer(x,x)
+    cholUpdate(self.L, x, -1.)
+  def logDet(self):
+    ''' log determinant of delta + scatter '''
+    return 2.*np.log(np.diag(self.L)).sum()
+
 class IW(object):
   '''
   inverse wishart distribution
@@ -113,25 +229,63 @@ class IW(object):
       scatter = np.dot(x,x.T) 
       return IW(s.delta+scatter,s.nu+n)
 
-  def sample(s):
-    return sample_invwishart(s.delta,s.nu)
+  def sample(s,n=None,rng=None):
+    '''
+    one sample or n samples as a nxdxd stack drawn with the random number
+    generator rng (numpy.random by default)
+    '''
+    if n is None:
+      return sample_invwishart(s.delta,s.nu)
+    from sampling import sample_invwishart_batch
+    return sample_invwishart_batch(s.delta,s.nu,n,s.cholDelta(),rng)
+
+  def cholDelta(s):
+    if not hasattr(s,'L'):
+      s.L = np.linalg.cholesky(s.delta)
+    return s.L
 
   def logMarginalLikelihood(s,x):
     d = s.delta.shape[0]
-    n=x.shape[1]
     if not x.shape[0] == d:
       raise ValueError
-    scatter = np.dot(x,x.T) 
-    (sign,logdetD) = np.linalg.slogdet(s.delta)
-    (sign,logdetDS) = np.linalg.slogdet(s.delta+scatter)
+    return s.logMarginalLikelihoodStats(s.suffStats(x))
+
+  def suffStats(s,x=None):
+    ''' sufficient statistics of the dxn x (none if x is None) '''
+    return SuffStats(s.delta,x)
 
+  def logDetDelta(s):
+    if not hasattr(s,'logdetD'):
+      (sign,s.logdetD) = np.linalg.slogdet(s.delta)
+    return s.logdetD
+
+  def logMarginalLikelihoodStats(s,ss):
+    ''' log marginal likelihood of the data with sufficient stats ss '''
+    d = s.delta.shape[0]
+    n = ss.n
     logP = multigammaln((s.nu+n)*.5,d) - multigammaln(s.nu*.5,d)
     logP -= 0.5*(n*d)*np.log(np.pi)
-    logP += s.nu*0.5 * logdetD
-    logP -= (s.nu+n)*0.5 * logdetDS
-     
+    logP += s.nu*0.5 * s.logDetDelta()
+    logP -= (s.nu+n)*0.5 * ss.logDet()
+    return logP
+
+  def logPredictiveStats(s,ss,x):
+    '''
+    log predictive density of x given the data with sufficient stats ss
+    in O(d^2) from det(A + x x^T) = det(A)(1 + x^T A^-1 x)
+    '''
+    d = s.delta.shape[0]
+    nu = s.nu+ss.n
+    z = solve_triangular(ss.L, x, lower=True)
+    logdetA = ss.logDet()
+    logP = multigammaln((nu+1.)*.5,d) - multigammaln(nu*.5,d)
+    logP -= 0.5*d*np.log(np.pi)
+    logP -= 0.5*logdetA + (nu+1.)*0.5*np.log1p((z**2).sum())
     return logP
 
+  def posteriorFromStats(s,ss):
+    return IW(s.delta+ss.scatter,s.nu+ss.n)
+
 class NIW(object):
   '''
   normal inverse wishart
@@ -140,27 +294,120 @@ class NIW(object):
     self.iw = IW(delta, nu)
     self.vartheta = vartheta
     self.lamb = lamb
-  def sample(self):
+  def sample(self, n=None, rng=None):
+    '''
+    one Gaussian or the means (nxd) and covariances (nxdxd) of n samples
+    drawn with the random number generator rng (numpy.random by default)
+    '''
+    if not n is None:
+      from sampling import sample_niw_batch
+      return sample_niw_batch(self.vartheta, self.iw.delta, self.lamb,
+          self.iw.nu, n, self.iw.cholDelta(), rng)
     Sigma = self.iw.sample()
     self.normal = Gaussian(self.vartheta, Sigma/self.lamb)
     mu = self.normal.sample()
     return Gaussian(mu,Sigma)
 
+  def suffStats(self, x=None):
+    '''
+    sufficient statistics of the dxn x (none if x is None); the Cholesky
+    factor is the one of delta + lamb vartheta vartheta^T + scatter
+    '''
+    return SuffStats(self.iw.delta + self.lamb*np.outer(self.vartheta,
+      self.vartheta), x)
+
+  def posteriorFromStats(self, ss):
+    lamb = self.lamb + ss.n
+    vartheta = (self.lamb*self.vartheta + ss.xSum)/lamb
+    delta = ss.delta + ss.scatter - lamb*np.outer(vartheta,vartheta)
+    return NIW(delta, self.iw.nu + ss.n, vartheta, lamb)
+
+  def logMarginalLikelihoodStats(self, ss):
+    '''
+    log marginal likelihood of the data with sufficient stats ss; the
+    posterior delta is a rank-1 downdate of the cached Cholesky factor
+    '''
+    d = self.vartheta.size
+    n = ss.n
+    lamb = self.lamb + n
+    nu = self.iw.nu + n
+    vartheta = (self.lamb*self.vartheta + ss.xSum)/lamb
+    L = cholUpdate(ss.L.copy(), np.sqrt(lamb)*vartheta, -1.)
+    logdetDn = 2.*np.log(np.diag(L)).sum()
+    logP = multigammaln(nu*.5,d) - multigammaln(self.iw.nu*.5,d)
+    logP -= 0.5*(n*d)*np.log(np.pi)
+    logP += self.iw.nu*0.5 * self.iw.logDetDelta()
+    logP -= nu*0.5 * logdetDn
+    logP += 0.5*d*(np.log(self.lamb) - np.log(lamb))
+    return logP
+
+  def logMarginalLikelihood(self, x):
+    return self.logMarginalLikelihoodStats(self.suffStats(x))
+
+  def logPredictiveStats(self, ss, x):
+    ''' log predictive density of x given the data with sufficient stats ss '''
+    ssx = ss.copy()
+    ssx.add(x)
+    return self.logMarginalLikelihoodStats(ssx) \
+        - self.logMarginalLikelihoodStats(ss)
+
 class Gaussian(object):
-  def __init__(self, mu, Sigma):
+  '''
+  Gaussian with the Cholesky factor of Sigma (optionally passed in as
+  cholSigma) and its log determinant computed once at construction.
+  '''
+  def __init__(self, mu, Sigma, cholSigma=None):
     self.mu = mu
     self.Sigma = Sigma
     self.d = Sigma.shape[0]
-    self.sqrtSigma = sqrtm(self.Sigma)
-  def sample(self):
-    return self.sqrtSigma.real.dot(np.random.normal(size=(self.d))) + self.mu
+    if cholSigma is None:
+      cholSigma = np.linalg.cholesky(Sigma)
+    self.cholSigma = cholSigma
+    self.logDetSigma = 2.*np.log(np.diag(self.cholSigma)).sum()
+  def sample(self, n=None):
+    ''' one sample or n samples as the columns of a dxn array '''
+    if n is None:
+      return self.cholSigma.dot(np.random.normal(size=(self.d))) + self.mu
+    return self.cholSigma.dot(np.random.normal(size=(self.d,n))) \
+        + self.mu[:,np.newaxis]
   def logPdf(self,x):
+    ''' log density at x (d) or at the columns of x (dxN) '''
     if  not self.d == x.shape[0]:
       raise ValueError
-    logP = -0.5*(np.linalg.solve(self.Sigma, x) * x).sum(axis=0)
-    logP += -0.5*(self.d*math.log(2.*math.pi)+np.linalg.slogdet(self.Sigma)[1])
+    z = solve_triangular(self.cholSigma, (x.T - self.mu).T, lower=True)
+    logP = -0.5*(z**2).sum(axis=0)
+    logP += -0.5*(self.d*math.log(2.*math.pi)+self.logDetSigma)
     return logP
 
+def logPdfGMM(gaussians, pi, x, responsibilities=False, chunkSize=4096):
+  '''
+  Log densities of the mixture of the K Gaussians with weights pi at the
+  columns of the dxN x or with responsibilities the KxN posterior
+  probabilities of the components. All components are evaluated at once
+  per chunk of chunkSize points with the inverses of their cached
+  Cholesky factors.
+  '''
+  d, N = x.shape
+  K = len(gaussians)
+  Linv = np.zeros((K,d,d))
+  logC = np.zeros(K)
+  for k,g in enumerate(gaussians):
+    Linv[k] = solve_triangular(g.cholSigma, np.eye(d), lower=True)
+    logC[k] = np.log(pi[k]) - 0.5*(d*math.log(2.*math.pi)+g.logDetSigma)
+  Linvmu = np.einsum('kde,ke->kd', Linv, np.array([g.mu for g in gaussians]))
+  out = np.zeros((K,N)) if responsibilities else np.zeros(N)
+  for i0 in range(0,N,chunkSize):
+    i1 = min(i0+chunkSize,N)
+    z = np.einsum('kde,en->kdn', Linv, x[:,i0:i1]) - Linvmu[:,:,np.newaxis]
+    logPdfs = logC[:,np.newaxis] - 0.5*(z**2).sum(axis=1)
+    logPmax = logPdfs.max(axis=0)
+    logPdf = np.log(np.exp(logPdfs - logPmax).sum(axis=0)) + logPmax
+    if responsibilities:
+      out[:,i0:i1] = np.exp(logPdfs - logPdf)
+    else:
+      out[i0:i1] = logPdf
+  return out
+
 
 if __name__ == "__main__":
 
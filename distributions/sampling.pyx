@@ -15,30 +15,67 @@ ctypedef np.float64_t my_dtype
 
 def choice(np.ndarray[my_dtype, ndim=1] p, int n):
   ''' 
-  draw n samples from a discrete pdf described by p
+  draw n samples from a discrete pdf described by p (normalized here) by
+  binary search in its cdf in O(log K) per sample
   '''
-  cdef np.ndarray[my_dtype, ndim=1] P = np.zeros(p.size+1)
-  P[1::] = np.cumsum(p)
-  cdef np.ndarray[np.int32_t, ndim=1] ind = np.arange(P.size,dtype=np.int32)
-  cdef np.ndarray[np.int32_t, ndim=1] c = np.zeros(n,dtype=np.int32)
-  cdef np.ndarray[my_dtype, ndim=1] x = rnd.rand(n)
-  for i in xrange(n):
-    c[i] = np.max(ind[P<=x[i]]) 
-  return c
+  cdef np.ndarray[my_dtype, ndim=1] P = np.cumsum(p)
+  cdef np.ndarray[my_dtype, ndim=1] x = rnd.rand(n)*P[P.size-1]
+  return np.searchsorted(P,x,side='right').astype(np.int32)
 
 def choiceMult(np.ndarray[my_dtype, ndim=2] p):
   ''' 
   draw 1 samples from each of the discrete pdfs described by
-  the rows of p
+  the rows of p (normalized here) all at once
   '''
-  cdef np.ndarray[my_dtype, ndim=2] P = np.zeros((p.shape[0],p.shape[1]+1))
-  P[:,1::] = np.cumsum(p,axis=1)
-  cdef np.ndarray[np.int32_t, ndim=1] ind = np.arange(P.shape[1],dtype=np.int32)
-  cdef np.ndarray[np.int32_t, ndim=1] c = np.zeros(P.shape[0],dtype=np.int32)
-  cdef np.ndarray[my_dtype, ndim=1] x = rnd.rand(P.shape[0])
-  for i in xrange(P.shape[0]):
-    c[i] = np.max(ind[P[i,:]<=x[i]]) 
-  return c
+  cdef np.ndarray[my_dtype, ndim=2] P = np.cumsum(p,axis=1)
+  cdef np.ndarray[my_dtype, ndim=1] x = rnd.rand(P.shape[0])*P[:,P.shape[1]-1]
+  return (P <= x[:,np.newaxis]).sum(axis=1).astype(np.int32)
+
+class AliasTable(object):
+  '''
+  Walker alias table of the discrete pdf p (built in O(K) with Vose's
+  method) to draw many samples from it in O(1) each.
+  '''
+  def __init__(self, np.ndarray[my_dtype, ndim=1] p):
+    cdef int K = p.size
+    cdef np.ndarray[my_dtype, ndim=1] q = p*K/p.sum()
+    cdef np.ndarray[my_dtype, ndim=1] prob = np.ones(K)
+    cdef np.ndarray[np.int32_t, ndim=1] alias = np.arange(K,dtype=np.int32)
+    cdef np.ndarray[np.int32_t, ndim=1] small = np.zeros(K,dtype=np.int32)
+    cdef np.ndarray[np.int32_t, ndim=1] large = np.zeros(K,dtype=np.int32)
+    cdef int nSmall = 0, nLarge = 0, i, s, l
+    for i in range(K):
+      if q[i] < 1.:
+        small[nSmall] = i
+        nSmall += 1
+      else:
+        large[nLarge] = i
+        nLarge += 1
+    while nSmall > 0 and nLarge > 0:
+      nSmall -= 1
+      s = small[nSmall]
+      l = large[nLarge-1]
+      prob[s] = q[s]
+      alias[s] = l
+      q[l] = q[l] + q[s] - 1.
+      if q[l] < 1.:
+        nLarge -= 1
+        small[nSmall] = l
+        nSmall += 1
+    # whatever is left has probability 1 up to round off
+    self.prob = prob
+    self.alias = alias
+  def sample(self, int n, rng=None):
+    '''
+    draw n samples with the random number generator rng (numpy.random
+    by default); one uniform number per sample picks the column and
+    decides between it and its alias
+    '''
+    if rng is None:
+      rng = rnd
+    cdef np.ndarray[my_dtype, ndim=1] x = rng.uniform(size=n)*self.prob.size
+    cdef np.ndarray[np.int32_t, ndim=1] i = x.astype(np.int32)
+    return np.where(x-i < self.prob[i], i, self.alias[i])
 
 
 def sample_niw(mu_0,lmbda_0,kappa_0,nu_0):
@@ -91,6 +128,56 @@ def sample_wishart(sigma, dof):
 
     return np.dot(X,X.T)
 
+def sample_wishart_batch(sigma, dof, n, chol=None, rng=None):
+    '''
+    Returns n samples (nxdxd) from the Wishart distribution with scale
+    sigma via a vectorized Bartlett decomposition W = (L A)(L A)^T where
+    sigma = L L^T and A is lower triangular with sqrt(chi2(dof-i)) on the
+    diagonal and standard normals below. The Cholesky factor L can be
+    passed in as chol. rng is the random number generator to draw from
+    (e.g. a numpy.random.RandomState per worker); numpy.random by default.
+    '''
+    X = np.matmul(_chol(sigma,chol), _bartlett(sigma.shape[0],dof,n,rng))
+    return np.matmul(X, X.transpose(0,2,1))
 
+def sample_invwishart_batch(lmbda, dof, n, chol=None, rng=None):
+    '''
+    Returns n samples (nxdxd) from the inverse Wishart distribution with
+    scale lmbda: with lmbda = L L^T and the Bartlett factors A of
+    W(lmbda^-1,dof) samples the inverse is (L A^-T)(L A^-T)^T. chol and
+    rng as in sample_wishart_batch.
+    '''
+    T = _invwishart_factors(lmbda, dof, n, chol, rng)
+    return np.matmul(T, T.transpose(0,2,1))
 
-
+def sample_niw_batch(mu_0, lmbda_0, kappa_0, nu_0, n, chol=None, rng=None):
+    '''
+    Returns n samples of means (nxd) and covariances (nxdxd) from the
+    normal/inverse-wishart distribution (see sample_niw). chol and rng as
+    in sample_wishart_batch.
+    '''
+    if rng is None:
+      rng = rnd
+    T = _invwishart_factors(lmbda_0, nu_0, n, chol, rng)
+    z = rng.normal(size=(n,mu_0.size,1))
+    mu = mu_0 + np.matmul(T, z)[:,:,0]/np.sqrt(kappa_0)
+    return mu, np.matmul(T, T.transpose(0,2,1))
+
+def _chol(sigma, chol):
+    return np.linalg.cholesky(sigma) if chol is None else chol
+
+def _bartlett(d, dof, n, rng):
+    ''' n lower triangular Bartlett factors (nxdxd) of W(I,dof) '''
+    if rng is None:
+      rng = rnd
+    A = np.zeros((n,d,d))
+    il = np.tril_indices(d,-1)
+    A[:,il[0],il[1]] = rng.normal(size=(n,il[0].size))
+    A[:,np.arange(d),np.arange(d)] = np.sqrt(rng.chisquare(dof-np.arange(d),
+      size=(n,d)))
+    return A
+
+def _invwishart_factors(lmbda, dof, n, chol, rng):
+    ''' square roots L A^-T of n inverse Wishart samples '''
+    A = _bartlett(lmbda.shape[0], dof, n, rng)
+    return np.matmul(_chol(lmbda,chol), np.linalg.inv(A).transpose(0,2,1))
@@ -204,6 +204,25 @@ class IcoSphere(object):
         c /= np.sqrt((c**2).sum())
         cs[i_tri,:] = c
       return cs
+    def GetTriangleIDsAtLevel(self, directions, level):
+      '''
+      Triangle IDs at the given level for all Nx3 directions at once by
+      descending from the base triangles into the child triangle with the
+      closest center. Directions close to an edge may end up in the
+      neighboring triangle.
+      '''
+      cs = self.GetTriangleCentersAtLevel(0)
+      j = np.argmax(directions.dot(cs.T), axis=1)
+      for lvl in range(level):
+        cs = self.GetTriangleCentersAtLevel(lvl+1)
+        # children of triangle j (indexed over all levels) within level
+        # lvl+1
+        children = 4*j[:,np.newaxis] + np.arange(4)[np.newaxis,:]
+        dots = np.einsum('nd,ncd->nc', directions, cs[children,:])
+        j = children[np.arange(j.size), np.argmax(dots, axis=1)] \
+            + self.tri_levels[lvl+1]
+      return j - self.tri_levels[level]
+
     def GetTriangleAreasAtLevel(self, level):
       tri = self.tri[self.tri_levels[level]:self.tri_levels[level+1], :]
       areas = np.zeros(tri.shape[0])